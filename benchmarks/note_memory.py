@@ -0,0 +1,112 @@
+"""比较原始字典和slots数据类保存笔记时的内存占用
+
+python -m benchmarks.note_memory --books 500 --notes 300
+"""
+import argparse
+import gc
+import random
+import tracemalloc
+
+from weread2notionpro.weread_api import parse_bookmarks, parse_chapters, parse_reviews
+
+
+def make_library(books, notes):
+    """生成和微信读书接口格式一致的划线、笔记和章节"""
+    random.seed(0)
+    library = []
+    for i in range(books):
+        bookId = str(100000 + i)
+        chapters = [
+            {
+                "bookId": bookId,
+                "chapterUid": uid,
+                "chapterIdx": uid,
+                "updateTime": 1683825006,
+                "readAhead": 0,
+                "title": f"第{uid}章",
+                "level": 1,
+                "tar": "",
+                "wordCount": random.randint(1000, 9000),
+            }
+            for uid in range(1, 31)
+        ]
+        bookmarks = []
+        for j in range(notes):
+            start = random.randint(0, 9000)
+            bookmarks.append(
+                {
+                    "bookId": bookId,
+                    "bookmarkId": f"{bookId}_{j}_{start}",
+                    "bookVersion": 1,
+                    "chapterUid": random.randint(1, 30),
+                    "chapterName": "章节",
+                    "chapterIdx": 1,
+                    "colorStyle": random.randint(0, 5),
+                    "contextAbstract": "",
+                    "createTime": 1683825006 + j,
+                    "markText": "划线内容" * random.randint(5, 30),
+                    "range": f"{start}-{start + 50}",
+                    "style": random.randint(0, 2),
+                    "type": 1,
+                }
+            )
+        reviews = [
+            {
+                "review": {
+                    "bookId": bookId,
+                    "reviewId": f"{bookId}_review_{j}",
+                    "abstract": "原文" * 20,
+                    "content": "笔记内容" * 10,
+                    "chapterUid": random.randint(1, 30),
+                    "createTime": 1683825006 + j,
+                    "range": "100-200",
+                    "type": 1,
+                    "userVid": 1,
+                    "isPrivate": 0,
+                }
+            }
+            for j in range(notes // 10)
+        ]
+        library.append((chapters, bookmarks, reviews))
+    return library
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    data = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del data
+    return current
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--books", type=int, default=200)
+    parser.add_argument("--notes", type=int, default=300)
+    options = parser.parse_args()
+
+    def build_dicts():
+        # 原来的做法：保留接口返回的字典，点评补上chapterUid
+        return [
+            (chapters, bookmarks, [x.get("review") for x in reviews])
+            for chapters, bookmarks, reviews in make_library(options.books, options.notes)
+        ]
+
+    def build_models():
+        return [
+            (parse_chapters(chapters), parse_bookmarks(bookmarks), parse_reviews(reviews))
+            for chapters, bookmarks, reviews in make_library(options.books, options.notes)
+        ]
+
+    dicts = measure(build_dicts)
+    models = measure(build_models)
+    count = options.books * (30 + options.notes + options.notes // 10)
+    print(f"{options.books}本书，共{count}条记录")
+    print(f"字典: {dicts / 1024 / 1024:.1f} MiB")
+    print(f"数据类: {models / 1024 / 1024:.1f} MiB ({models / dicts:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,14 +8,16 @@ setup(
         "pendulum",
         "retrying",
         "notion-client",
-        "github-heatmap",
-        "github-heatmap",
+        "httpx",
     ],
     entry_points={
         "console_scripts": [
             "book = weread2notionpro.book:main",
             "weread = weread2notionpro.weread:main",
             "read_time = weread2notionpro.read_time:main",
+            "heatmap = weread2notionpro.heatmap:main",
+            "sync = weread2notionpro.sync:main",
+            "benchmark = weread2notionpro.benchmark:main",
         ],
     },
     author="malinkang",
@@ -29,5 +31,5 @@ setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires=">=3.6",
+    python_requires=">=3.10",
 )
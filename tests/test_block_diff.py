@@ -0,0 +1,87 @@
+from weread2notionpro.block_diff import diff_blocks, get_block_hash, get_note_key
+from weread2notionpro.models import Bookmark
+from weread2notionpro.utils import get_block
+
+
+def get_bookmark(bookmark_id, text=None):
+    return Bookmark(bookmark_id=bookmark_id, mark_text=text or f"划线{bookmark_id}")
+
+
+def to_block(bookmark):
+    return get_block(bookmark.mark_text, "callout", True, None, None, None)
+
+
+def get_current(*bookmarks):
+    """模拟已经同步到页面中的块，块ID为 block-{id}"""
+    return {
+        get_note_key(x): (
+            f"block-{x.bookmark_id}",
+            f"page-{x.bookmark_id}",
+            None,
+            None,
+            get_block_hash(to_block(x)),
+            "callout",
+        )
+        for x in bookmarks
+    }
+
+
+def test_unchanged_notes_have_no_operations():
+    a, b = get_bookmark("a"), get_bookmark("b")
+    diff = diff_blocks([a, b], get_current(a, b), to_block)
+    assert diff.inserts == []
+    assert diff.updates == []
+    assert diff.deletes == {}
+
+
+def test_insert_in_the_middle_goes_after_previous_block():
+    a, b, c = get_bookmark("a"), get_bookmark("b"), get_bookmark("c")
+    diff = diff_blocks([a, b, c], get_current(a, c), to_block)
+    assert diff.inserts == [("block-a", [b])]
+    assert diff.updates == []
+    assert diff.deletes == {}
+
+
+def test_insert_before_first_block_goes_after_toc():
+    a, b = get_bookmark("a"), get_bookmark("b")
+    diff = diff_blocks([a, b], get_current(b), to_block)
+    assert diff.inserts == [(None, [a])]
+
+
+def test_edit_updates_in_place():
+    a, b = get_bookmark("a"), get_bookmark("b")
+    edited = get_bookmark("b", "修改后的划线")
+    diff = diff_blocks([a, edited], get_current(a, b), to_block)
+    assert diff.inserts == []
+    assert diff.deletes == {}
+    assert [content for content, _ in diff.updates] == [edited]
+    assert edited.block_id == "block-b"
+    assert diff.hashes[get_note_key(edited)] == (get_block_hash(to_block(edited)), "callout")
+
+
+def test_remove_deletes_only_missing_notes():
+    a, b, c = get_bookmark("a"), get_bookmark("b"), get_bookmark("c")
+    current = get_current(a, b, c)
+    diff = diff_blocks([a, c], current, to_block)
+    assert diff.inserts == []
+    assert diff.updates == []
+    assert diff.deletes == {get_note_key(b): current.get(get_note_key(b))}
+
+
+def test_reorder_keeps_existing_blocks():
+    # Notion不能移动块，已有的块保持原来的位置，新笔记插入到新顺序中前一个已有块的后面
+    a, b, c = get_bookmark("a"), get_bookmark("b"), get_bookmark("c")
+    diff = diff_blocks([b, a, c], get_current(a, b), to_block)
+    assert diff.updates == []
+    assert diff.deletes == {}
+    assert diff.inserts == [("block-a", [c])]
+
+
+def test_block_type_change_reinserts():
+    a = get_bookmark("a")
+    current = get_current(a)
+    key = get_note_key(a)
+    current[key] = current.get(key)[:5] + ("quote",)
+    diff = diff_blocks([a], current, to_block)
+    assert diff.inserts == [(None, [a])]
+    assert diff.deletes == {key: current.get(key)}
@@ -0,0 +1,105 @@
+from types import SimpleNamespace
+
+import pytest
+
+from weread2notionpro import weread
+from weread2notionpro.block_diff import diff_blocks, get_block_hash, get_note_key
+from weread2notionpro.models import Bookmark, Review
+from weread2notionpro.notion_helper import NotionHelper
+from weread2notionpro.sync_state import SyncState
+from weread2notionpro.utils import get_block, get_quote
+
+
+class FakeBlocks:
+    def __init__(self, children):
+        self.children_by_id = children
+        self.updates = []
+        self.listed = []
+        self.children = SimpleNamespace(list=self.list, append=self.append)
+
+    def list(self, block_id):
+        self.listed.append(block_id)
+        return {"results": self.children_by_id.get(block_id, [])}
+
+    def append(self, block_id, children):
+        raise AssertionError("子块类型没有变化，不应该重新插入")
+
+    def update(self, block_id, **kwargs):
+        self.updates.append((block_id, kwargs))
+        return {"id": block_id, "has_children": bool(self.children_by_id.get(block_id))}
+
+    def delete(self, block_id):
+        raise AssertionError("子块类型没有变化，不应该删除")
+
+
+def get_review(abstract):
+    return Review(review_id="r1", content="笔记内容", abstract=abstract)
+
+
+def to_block(review):
+    return get_block(review.content, "callout", True, None, None, review.review_id, review.abstract)
+
+
+def get_notion_child(child_id, text):
+    quote = get_quote(text)
+    quote["id"] = child_id
+    quote["quote"]["rich_text"][0]["plain_text"] = text
+    return quote
+
+
+@pytest.fixture
+def helper():
+    helper = NotionHelper.__new__(NotionHelper)
+    helper.client = SimpleNamespace(
+        blocks=FakeBlocks({"b1": [get_notion_child("c1", "旧的原文")]}),
+        pages=SimpleNamespace(update=lambda **kwargs: {}),
+    )
+    return helper
+
+
+def test_only_abstract_changed_updates_child_quote(helper, monkeypatch):
+    old = get_review("旧的原文")
+    new = get_review("新的原文")
+    key = get_note_key(new)
+    current = {key: ("b1", "p1", None, None, get_block_hash(to_block(old)), "callout")}
+    diff = diff_blocks([new], current, to_block)
+    assert [content for content, _ in diff.updates] == [new]
+
+    sync_state = SyncState(":memory:")
+    sync_state.put_note("book", key[0], key[1], "b1", "p1", None, None, "old", "callout")
+    monkeypatch.setattr(weread, "notion_helper", helper)
+    monkeypatch.setattr(weread, "sync_state", sync_state)
+    weread.update_blocks("book", current, diff.updates, diff.hashes)
+
+    updates = helper.client.blocks.updates
+    assert updates[-1][0] == "c1"
+    assert updates[-1][1]["quote"]["rich_text"][0]["text"]["content"] == "新的原文"
+    assert sync_state.get_notes("book", key[0])[key[1]][4] == get_block_hash(to_block(new))
+    assert not diff.hashes
+
+
+def test_hash_not_saved_when_child_update_fails(helper, monkeypatch):
+    def fail(block_id, block):
+        raise RuntimeError("更新子块失败")
+
+    old = get_review("旧的原文")
+    new = get_review("新的原文")
+    key = get_note_key(new)
+    current = {key: ("b1", "p1", None, None, get_block_hash(to_block(old)), "callout")}
+    diff = diff_blocks([new], current, to_block)
+    sync_state = SyncState(":memory:")
+    sync_state.put_note("book", key[0], key[1], "b1", "p1", None, None, "old", "callout")
+    monkeypatch.setattr(helper, "update_block", fail)
+    monkeypatch.setattr(weread, "notion_helper", helper)
+    monkeypatch.setattr(weread, "sync_state", sync_state)
+    with pytest.raises(RuntimeError):
+        weread.update_blocks("book", current, diff.updates, diff.hashes)
+    assert sync_state.get_notes("book", key[0])[key[1]][4] == "old"
+
+
+def test_block_without_children_is_not_listed(helper):
+    bookmark = Bookmark(bookmark_id="m1", mark_text="划线内容")
+    block = get_block(bookmark.mark_text, "callout", True, None, None, None)
+    helper.update_block("b2", block)
+    assert helper.client.blocks.updates[-1][0] == "b2"
+    assert helper.client.blocks.listed == []
@@ -0,0 +1,124 @@
+"""统计每个入口的耗时和各接口的请求次数
+
+benchmark record book weread read_time   # 真实运行一次并录制，会写入Notion
+benchmark replay book weread read_time   # 用录制的结果回放，不访问网络
+
+每个入口在单独的进程中运行，使用空的本地同步状态，保证录制和回放时发出的请求一致。
+"""
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from weread2notionpro.replay import DEFAULT_REPLAY_DIR, RECORD, REPLAY, get_stats
+
+ENTRIES = ("book", "weread", "read_time", "sync")
+# 不指定入口时分别运行三个同步任务
+DEFAULT_ENTRIES = ENTRIES[:3]
+# 录制时保存，回放时作为默认值的环境变量
+REPLAY_ENV = ("NOTION_PAGE", "REPOSITORY", "REF")
+
+
+def run_entry(entry, stats_file):
+    """子进程中运行入口的main，结束后把耗时和请求次数写入stats_file"""
+    started_at = time.perf_counter()
+    error = None
+    # 入口的main可能会解析命令行参数
+    sys.argv = [entry]
+    try:
+        importlib.import_module(f"weread2notionpro.{entry}").main()
+    except Exception as e:
+        error = str(e)
+    stats = {"entry": entry, "wall_time": time.perf_counter() - started_at}
+    stats.update(services=get_stats(), error=error)
+    with open(stats_file, "w") as f:
+        json.dump(stats, f, ensure_ascii=False)
+
+
+def load_env(directory):
+    path = os.path.join(directory, "env.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_env(directory):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "env.json"), "w") as f:
+        json.dump({key: os.getenv(key) for key in REPLAY_ENV if os.getenv(key)}, f)
+
+
+def benchmark(mode, entry, directory):
+    directory = os.path.join(directory, entry)
+    env = dict(os.environ)
+    if mode == RECORD:
+        save_env(directory)
+    else:
+        for key, value in load_env(directory).items():
+            env.setdefault(key, value)
+        env.setdefault("NOTION_TOKEN", "replay")
+    with tempfile.TemporaryDirectory() as tmp:
+        stats_file = os.path.join(tmp, "stats.json")
+        env.update(
+            HTTP_REPLAY=mode,
+            HTTP_REPLAY_DIR=directory,
+            SYNC_STATE_PATH=os.path.join(tmp, "sync_state.db"),
+            OUT_FOLDER=os.path.join(tmp, "OUT_FOLDER"),
+        )
+        subprocess.run(
+            [sys.executable, "-m", "weread2notionpro.benchmark", "--child", entry, stats_file],
+            env=env,
+        )
+        if not os.path.exists(stats_file):
+            return {"entry": entry, "wall_time": None, "services": {}, "error": "进程异常退出"}
+        with open(stats_file) as f:
+            return json.load(f)
+
+
+def report(stats):
+    wall_time = stats.get("wall_time")
+    wall_time = f"{wall_time:.2f}s" if wall_time is not None else "-"
+    print(f"\n{stats.get('entry')}: {wall_time}")
+    if stats.get("error"):
+        print(f"  出错: {stats.get('error')}")
+    for service, service_stats in stats.get("services").items():
+        requests = service_stats.get("requests")
+        print(f"  {service}: 共{sum(requests.values())}次请求")
+        for route, count in sorted(requests.items(), key=lambda x: -x[1]):
+            print(f"    {count:6d}  {route}")
+        for route, count in service_stats.get("misses").items():
+            print(f"    回放中缺少{count}次 {route}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="统计每个入口的耗时和请求次数")
+    parser.add_argument("--child", nargs=2, help=argparse.SUPPRESS)
+    parser.add_argument("mode", nargs="?", choices=(RECORD, REPLAY), default=REPLAY)
+    parser.add_argument("entries", nargs="*", help=f"可选 {' '.join(ENTRIES)}，默认运行 {' '.join(DEFAULT_ENTRIES)}")
+    parser.add_argument("--dir", default=DEFAULT_REPLAY_DIR, help="录制结果保存的目录")
+    parser.add_argument("--output", help="把统计结果保存为JSON文件")
+    options = parser.parse_args()
+    if options.child:
+        run_entry(*options.child)
+        return
+    for entry in options.entries:
+        if entry not in ENTRIES:
+            parser.error(f"不支持的入口{entry}，可选 {' '.join(ENTRIES)}")
+    results = [
+        benchmark(options.mode, entry, options.dir)
+        for entry in options.entries or DEFAULT_ENTRIES
+    ]
+    for stats in results:
+        report(stats)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, ensure_ascii=False, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import hashlib
+import json
+
+
+def get_note_key(content):
+    """笔记在页面中的唯一标识 (kind, id)"""
+    return (content.kind, content.note_id)
+
+
+def get_block_hash(block):
+    """块内容的摘要，用来判断笔记是否被修改"""
+    data = json.dumps(block, sort_keys=True, ensure_ascii=False)
+    return hashlib.md5(data.encode("utf-8")).hexdigest()
+
+
+class BlockDiff:
+    """diff_blocks的结果"""
+
+    def __init__(self):
+        # [(after, [content])]，after为None时插入到目录后面
+        self.inserts = []
+        # [(content, block)]，内容变化的块原地更新
+        self.updates = []
+        # {(kind, id): note}，页面中多余的块
+        self.deletes = {}
+        # {(kind, id): (hash, type)}，需要记录到本地状态的摘要
+        self.hashes = {}
+
+
+def diff_blocks(contents, current, to_block, should_insert=None):
+    """比较期望的笔记顺序和页面中已有的块，得到最少的插入、更新和删除操作
+
+    contents是排好序的笔记，current是已经同步的笔记 {(kind, id): (blockId, pageId, chapterUid, range, hash, type)}。
+    已有的块内容变化时原地更新，块类型变化时删除后重新插入，新笔记插入到前一个已有块的后面，
+    current中不在contents里的块删除。anchor为True的笔记内容没有变化，不需要比较。
+    """
+    diff = BlockDiff()
+    kept = set()
+    after = None
+    run = []
+    for content in contents:
+        key = get_note_key(content)
+        note = current.get(key)
+        if note is not None and not content.anchor:
+            block = to_block(content)
+            block_hash = get_block_hash(block)
+            if note[5] is not None and note[5] != block.get("type"):
+                # 块类型不能修改，只能重新插入
+                note = None
+            elif note[4] != block_hash:
+                if note[4] is not None:
+                    diff.updates.append((content, block))
+                diff.hashes[key] = (block_hash, block.get("type"))
+        if note is None:
+            if should_insert is None or should_insert(content):
+                run.append(content)
+            continue
+        kept.add(key)
+        content.block_id = note[0]
+        if run:
+            diff.inserts.append((after, run))
+            run = []
+        after = note[0]
+    if run:
+        diff.inserts.append((after, run))
+    diff.deletes = {key: note for key, note in current.items() if key not in kept}
+    return diff
@@ -1,27 +1,32 @@
+import os
+from datetime import timedelta
+
 import pendulum
-from weread2notionpro.notion_helper import NotionHelper
-from weread2notionpro.weread_api import WeReadApi
+from weread2notionpro.concurrency import ordered_map
+from weread2notionpro.notion_helper import NOTION_CONCURRENCY, NotionHelper
+from weread2notionpro.weread_api import WeReadApi, parse_book_progress
 from weread2notionpro import utils
-from weread2notionpro.config import book_properties_type_dict, tz
+from weread2notionpro.config import book_properties_type_dict
+from weread2notionpro.date_dimension import build_calendar
 
 TAG_ICON_URL = "https://www.notion.so/icons/tag_gray.svg"
 USER_ICON_URL = "https://www.notion.so/icons/user-circle-filled_gray.svg"
 BOOK_ICON_URL = "https://www.notion.so/icons/book_gray.svg"
 rating = {"poor": "⭐️", "fair": "⭐️⭐️⭐️", "good": "⭐️⭐️⭐️⭐️⭐️"}
+# 阅读记录攒够这么多条再一起并发写入
+READ_DATA_BATCH_SIZE = int(os.getenv("READ_DATA_BATCH_SIZE", 50))
 
 
 
-def insert_book_to_notion(books, index, bookId):
-    """插入Book到Notion"""
+def insert_book_to_notion(books, index, bookId, bookInfo, readInfo):
+    """插入Book到Notion，bookInfo和readInfo已经提前获取"""
     book = {}
     if bookId in archive_dict:
         book["书架分类"] = archive_dict.get(bookId)
     if bookId in notion_books:
         book.update(notion_books.get(bookId))
-    bookInfo = weread_api.get_bookinfo(bookId)
     if bookInfo != None:
         book.update(bookInfo)
-    readInfo = weread_api.get_read_info(bookId)
     # 研究了下这个状态不知道什么情况有的虽然读了状态还是1 markedStatus = 1 想读 4 读完 其他为在读
     readInfo.update(readInfo.get("readDetail", {}))
     readInfo.update(readInfo.get("bookInfo", {}))
@@ -104,8 +109,26 @@ def insert_book_to_notion(books, index, bookId):
 
 
 def insert_read_data(page_id, readTimes):
-    readTimes = dict(sorted(readTimes.items()))
+    """只比较上次同步到的那一天及之后的阅读记录，需要写入的先放到队列中批量写入"""
+    state_key = f"read_data:{page_id}"
+    last_read_date = notion_helper.sync_state.get_value(state_key)
+    # 上次同步的最后一天可能还在继续阅读，所以包含这一天
+    readTimes = {
+        int(key): value
+        for key, value in sorted(readTimes.items())
+        if last_read_date is None or int(key) >= last_read_date
+    }
+    if not readTimes:
+        return
+    calendar = build_calendar(readTimes.keys())
     filter = {"property": "书架", "relation": {"contains": page_id}}
+    if last_read_date is not None:
+        filter = {
+            "and": [
+                filter,
+                {"property": "时间戳", "number": {"greater_than_or_equal_to": last_read_date}},
+            ]
+        }
     results = notion_helper.query_all_by_book(notion_helper.read_database_id, filter)
     for result in results:
         timestamp = result.get("properties").get("时间戳").get("number")
@@ -114,27 +137,36 @@ def insert_read_data(page_id, readTimes):
         if timestamp in readTimes:
             value = readTimes.pop(timestamp)
             if value != duration:
-                insert_to_notion(
-                    page_id=id,
-                    timestamp=timestamp,
-                    duration=value,
-                    book_database_id=page_id,
+                read_data_writes.append(
+                    (id, timestamp, value, page_id, calendar.get(timestamp))
                 )
     for key, value in readTimes.items():
-        insert_to_notion(None, int(key), value, page_id)
+        read_data_writes.append((None, key, value, page_id, calendar.get(key)))
+    read_data_states[state_key] = max(calendar)
+    if len(read_data_writes) >= READ_DATA_BATCH_SIZE:
+        flush_read_data()
+
 
+def flush_read_data():
+    """并发写入队列中的阅读记录，全部写入成功后才保存每本书同步到的日期"""
+    writes = list(read_data_writes)
+    read_data_writes.clear()
+    if writes:
+        print(f"正在写入{len(writes)}条阅读记录")
+    for _ in ordered_map(lambda x: insert_to_notion(*x), writes, NOTION_CONCURRENCY):
+        pass
+    for key, value in read_data_states.items():
+        notion_helper.sync_state.set_value(key, value)
+    read_data_states.clear()
 
-def insert_to_notion(page_id, timestamp, duration, book_database_id):
+
+def insert_to_notion(page_id, timestamp, duration, book_database_id, day):
     parent = {"database_id": notion_helper.read_database_id, "type": "database_id"}
+    # 时间戳不一定是当天0点，日期保留时分秒
+    date = day.date + timedelta(seconds=int(timestamp) - day.timestamp)
     properties = {
-        "标题": utils.get_title(
-            pendulum.from_timestamp(timestamp, tz=tz).to_date_string()
-        ),
-        "日期": utils.get_date(
-            start=pendulum.from_timestamp(timestamp, tz=tz).format(
-                "YYYY-MM-DD HH:mm:ss"
-            )
-        ),
+        "标题": utils.get_title(day.iso_date),
+        "日期": utils.get_date(start=utils.format_date(date)),
         "时长": utils.get_number(duration),
         "时间戳": utils.get_number(timestamp),
         "书架": utils.get_relation([book_database_id]),
@@ -149,19 +181,30 @@ def insert_to_notion(page_id, timestamp, duration, book_database_id):
         )
 
 
-weread_api = WeReadApi()
-notion_helper = NotionHelper()
+weread_api = None
+notion_helper = None
 archive_dict = {}
 notion_books = {}
+# 等待写入的阅读记录 (page_id, timestamp, duration, book_database_id, day)
+read_data_writes = []
+# 写入成功后要保存的 {状态key: 同步到的readDate}
+read_data_states = {}
+
+
+def init(api=None, helper=None):
+    """创建WeReadApi和NotionHelper，统一入口会传入共享的实例"""
+    global weread_api, notion_helper
+    weread_api = api or weread_api or WeReadApi()
+    notion_helper = helper or notion_helper or NotionHelper()
 
 
 def main():
     global notion_books
     global archive_dict
+    init()
     bookshelf_books = weread_api.get_bookshelf()
     notion_books = notion_helper.get_all_book()
-    bookProgress = bookshelf_books.get("bookProgress")
-    bookProgress = {book.get("bookId"): book for book in bookProgress}
+    bookProgress = parse_book_progress(bookshelf_books.get("bookProgress"))
     for archive in bookshelf_books.get("archive"):
         name = archive.get("name")
         bookIds = archive.get("bookIds")
@@ -171,7 +214,7 @@ def main():
         if (
             (
                 key not in bookProgress
-                or value.get("readingTime") == bookProgress.get(key).get("readingTime")
+                or value.get("readingTime") == bookProgress.get(key).reading_time
             )
             and (archive_dict.get(key) == value.get("category"))
             and (value.get("cover") is not None)
@@ -186,8 +229,10 @@ def main():
     books = bookshelf_books.get("books")
     books = [d["bookId"] for d in books if "bookId" in d]
     books = list((set(notebooks) | set(books)) - set(not_need_sync))
-    for index, bookId in enumerate(books):
-        insert_book_to_notion(books, index, bookId)
+    details = weread_api.get_book_details(books)
+    for index, (bookId, (bookInfo, readInfo)) in enumerate(details):
+        insert_book_to_notion(books, index, bookId, bookInfo, readInfo)
+    flush_read_data()
 
 
 if __name__ == "__main__":
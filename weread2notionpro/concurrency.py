@@ -0,0 +1,122 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RateLimiter:
+    """令牌桶限流，多个线程共享，rate为每秒请求数"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """获取一个令牌，没有令牌时等待"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def ordered_map(fn, items, workers):
+    """用线程池并发执行fn，按items的顺序返回结果，最多同时提交workers*2个任务"""
+    if workers <= 1:
+        for item in items:
+            yield item, fn(item)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append((item, executor.submit(fn, item)))
+            if len(pending) >= workers * 2:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """遇到限流时暂停并把速率减半，之后每次成功请求逐步恢复到目标速率"""
+
+    def __init__(self, rate, min_rate=0.5, step=0.1):
+        super().__init__(rate)
+        self.target_rate = rate
+        self.min_rate = min_rate
+        self.step = step
+        self.paused_until = 0
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                wait = self.paused_until - time.monotonic()
+            if wait <= 0:
+                break
+            time.sleep(wait)
+        super().acquire()
+
+    def backoff(self, retry_after):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        print(f"请求被限流，{retry_after}秒后重试，速率降低到每秒{self.rate:.2f}次")
+
+    def recover(self):
+        with self.lock:
+            if self.rate < self.target_rate:
+                self.rate = min(self.target_rate, self.rate + self.step)
+
+
+_DONE = object()
+
+
+def prefetch(fn, items, depth):
+    """在后台线程中按顺序执行fn，最多提前准备depth个结果，让获取和写入同时进行"""
+    results = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(value):
+        while not stop.is_set():
+            try:
+                results.put(value, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def worker():
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                put((item, fn(item), None))
+        except Exception as e:
+            put((None, None, e))
+        finally:
+            put((_DONE, None, None))
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, result, error = results.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            yield item, result
+    finally:
+        stop.set()
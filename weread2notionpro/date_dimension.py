@@ -0,0 +1,94 @@
+"""日期维度：一次计算一批时间戳对应的日、周、月、年的标题和起止日期
+
+同一天只计算一次，解析出的年、月、周、日关联页面ID也记录在CalendarDay上，
+read_time、书架的阅读记录和笔记的日期关联共用。
+"""
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Optional
+
+from weread2notionpro.utils import (
+    get_first_and_last_day_of_month,
+    get_first_and_last_day_of_week,
+    get_first_and_last_day_of_year,
+)
+
+# 北京时间相对UTC的偏移（秒）
+UTC_OFFSET = 8 * 3600
+DAY_SECONDS = 24 * 3600
+
+
+@dataclass(slots=True)
+class CalendarDay:
+    # 当天0点（北京时间）的时间戳
+    timestamp: int
+    # 当天0点，不带时区的北京时间
+    date: datetime
+    title: str
+    iso_date: str
+    week_key: str
+    week_start: datetime
+    week_end: datetime
+    month_key: str
+    month_start: datetime
+    month_end: datetime
+    year_key: str
+    year_start: datetime
+    year_end: datetime
+    year_id: Optional[str] = None
+    month_id: Optional[str] = None
+    week_id: Optional[str] = None
+    day_id: Optional[str] = None
+
+
+def get_day_number(timestamp):
+    """北京时间1970年1月1日以来的天数"""
+    return (int(timestamp) + UTC_OFFSET) // DAY_SECONDS
+
+
+@lru_cache(maxsize=None)
+def get_calendar_day_by_number(day_number):
+    timestamp = day_number * DAY_SECONDS - UTC_OFFSET
+    date = datetime(1970, 1, 1) + timedelta(days=day_number)
+    year, week, _ = date.isocalendar()
+    week_start, week_end = get_first_and_last_day_of_week(date)
+    month_start, month_end = get_first_and_last_day_of_month(date)
+    year_start, year_end = get_first_and_last_day_of_year(date)
+    return CalendarDay(
+        timestamp=timestamp,
+        date=date,
+        title=date.strftime("%Y年%m月%d日"),
+        iso_date=date.strftime("%Y-%m-%d"),
+        week_key=f"{year}年第{week}周",
+        week_start=week_start,
+        week_end=week_end,
+        month_key=date.strftime("%Y年%-m月"),
+        month_start=month_start,
+        month_end=month_end,
+        year_key=date.strftime("%Y"),
+        year_start=year_start,
+        year_end=year_end,
+    )
+
+
+def get_calendar_day(date):
+    """date可以是北京时间的datetime（带不带时区都可以）或者CalendarDay"""
+    if isinstance(date, CalendarDay):
+        return date
+    day_number = (datetime(date.year, date.month, date.day) - datetime(1970, 1, 1)).days
+    return get_calendar_day_by_number(day_number)
+
+
+def build_calendar(timestamps):
+    """返回 {timestamp: CalendarDay}，同一天的时间戳共用一个CalendarDay"""
+    return {
+        timestamp: get_calendar_day_by_number(get_day_number(timestamp))
+        for timestamp in timestamps
+    }
+
+
+def get_days(timestamps):
+    """时间戳对应的日期，去重后按日期排序"""
+    days = {day.timestamp: day for day in build_calendar(timestamps).values()}
+    return [days.get(key) for key in sorted(days)]
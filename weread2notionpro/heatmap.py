@@ -0,0 +1,203 @@
+"""把每天的阅读时长渲染成SVG热力图，代替单独运行github_heatmap
+
+布局和github_heatmap生成的图一致：最上面是名字，每年一行，新的年份在上面，每列一周，从周一开始。
+read_time只生成SVG，Notion通过GitHub的链接加载图片，需要提交到仓库之后再运行本模块更新热力图的链接。
+"""
+import hashlib
+import os
+from datetime import date, timedelta
+from xml.sax.saxutils import escape
+
+import pendulum
+
+from weread2notionpro.date_dimension import build_calendar
+from weread2notionpro.notion_helper import NotionHelper
+
+# 热力图需要提交到仓库中的这个目录，Notion通过GitHub的链接加载
+OUT_FOLDER = os.getenv("OUT_FOLDER") or "./OUT_FOLDER"
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+HEATMAP_GUIDE = "https://mp.weixin.qq.com/s?__biz=MzI1OTcxOTI4NA==&mid=2247484145&idx=1&sn=81752852420b9153fc292b7873217651&chksm=ea75ebeadd0262fc65df100370d3f983ba2e52e2fcde2deb1ed49343fbb10645a77570656728&token=157143379&lang=zh_CN#rd"
+# 环境变量名: 默认颜色
+DEFAULT_COLORS = {
+    "BACKGROUND_COLOR": "#FFFFFF",
+    "TRACK_COLOR": "#ACE7AE",
+    "SPECIAL_COLOR": "#69C16E",
+    "SPECIAL_COLOR2": "#549F57",
+    "DOM_COLOR": "#EBEDF0",
+    "TEXT_COLOR": "#000000",
+}
+MARGIN = 10
+CELL_SIZE = 4
+CELL_STEP = 5.4
+YEAR_HEIGHT = 46.1
+# 阅读时长达到这两个分位数时使用SPECIAL_COLOR和SPECIAL_COLOR2
+SPECIAL_PERCENTILES = (50, 90)
+
+
+def get_colors():
+    return {key: os.getenv(key) or value for key, value in DEFAULT_COLORS.items()}
+
+
+def get_years(value=None):
+    """value为2024或者2018-2024，默认今年，返回从新到旧的年份"""
+    value = (value if value is not None else os.getenv("YEAR", "")).strip()
+    if not value:
+        return [pendulum.now("Asia/Shanghai").year]
+    start, _, end = value.partition("-")
+    start = int(start)
+    end = int(end) if end else start
+    return list(range(max(start, end), min(start, end) - 1, -1))
+
+
+def get_minutes(readTimes):
+    """readTimes为 {时间戳: 阅读秒数}，返回 {date: 阅读分钟数}"""
+    minutes = {}
+    for timestamp, day in build_calendar(readTimes.keys()).items():
+        key = day.date.date()
+        minutes[key] = minutes.get(key, 0) + (readTimes.get(timestamp) or 0) / 60
+    return minutes
+
+
+def get_thresholds(minutes):
+    values = sorted(x for x in minutes.values() if x > 0)
+    if not values:
+        return None, None
+    return tuple(
+        values[min(len(values) - 1, len(values) * percentile // 100)]
+        for percentile in SPECIAL_PERCENTILES
+    )
+
+
+def format_number(value):
+    return f"{round(value, 2):g}"
+
+
+def render_heatmap(readTimes, years=None, name=None):
+    """返回SVG的内容，相同的数据和配置总是生成相同的内容"""
+    years = years or get_years()
+    name = name if name is not None else os.getenv("NAME", "")
+    colors = get_colors()
+    minutes = get_minutes(readTimes)
+    special1, special2 = get_thresholds(minutes)
+    width = MARGIN * 2 + 53 * CELL_STEP
+    height = MARGIN * 2 + 4.4 + YEAR_HEIGHT * len(years)
+    text = colors.get("TEXT_COLOR")
+    elements = [
+        f'<rect fill="{colors.get("BACKGROUND_COLOR")}" height="{format_number(height)}" '
+        f'width="{format_number(width)}" x="0" y="0" />',
+        f'<text fill="{text}" style="font-size:6px; font-family:Arial; font-weight:bold;" '
+        f'x="{MARGIN}" y="{MARGIN}">{escape(name)}</text>',
+    ]
+    for index, year in enumerate(years):
+        y = MARGIN + 4.4 + YEAR_HEIGHT * index
+        first_day = date(year, 1, 1)
+        start = first_day - timedelta(days=first_day.weekday())
+        end = date(year, 12, 31)
+        total = sum(v for k, v in minutes.items() if k.year == year)
+        elements.append(
+            f'<text fill="{text}" style="font-size:3px; font-family:Arial;" '
+            f'x="{MARGIN}" y="{format_number(y)}">{year}: {format_number(total / 60)} hours</text>'
+        )
+        # 月份标在这个月第一个周一所在的列上，一月总是在第一列
+        for month in range(1, 13):
+            month_start = date(year, month, 1)
+            monday = month_start + timedelta(days=(7 - month_start.weekday()) % 7)
+            column = 0 if month == 1 else (monday - start).days // 7
+            elements.append(
+                f'<text fill="{text}" style="font-size:2.5px; font-family:Arial" '
+                f'x="{format_number(MARGIN + column * CELL_STEP)}" '
+                f'y="{format_number(y + 3.9)}">{MONTHS[month - 1]}</text>'
+            )
+        day = start
+        while day <= end:
+            offset = (day - start).days
+            x = MARGIN + offset // 7 * CELL_STEP
+            cell_y = y + 5.3 + offset % 7 * CELL_STEP
+            value = minutes.get(day, 0)
+            if value <= 0:
+                color = colors.get("DOM_COLOR")
+                title = day.isoformat()
+            else:
+                if value >= special2:
+                    color = colors.get("SPECIAL_COLOR2")
+                elif value >= special1:
+                    color = colors.get("SPECIAL_COLOR")
+                else:
+                    color = colors.get("TRACK_COLOR")
+                title = f"{day.isoformat()} {format_number(value)} mins"
+            elements.append(
+                f'<rect fill="{color}" height="{CELL_SIZE}" rx="1" ry="1" width="{CELL_SIZE}" '
+                f'x="{format_number(x)}" y="{format_number(cell_y)}"><title>{title}</title></rect>'
+            )
+            day += timedelta(days=1)
+    return (
+        '<?xml version="1.0" encoding="utf-8" ?>\n'
+        f'<svg baseProfile="full" height="{format_number(height)}mm" version="1.1" '
+        f'viewBox="0,0,{format_number(width)},{format_number(height)}" '
+        f'width="{format_number(width)}mm" xmlns="http://www.w3.org/2000/svg">'
+        + "".join(elements)
+        + "</svg>"
+    )
+
+
+def write_heatmap(readTimes, folder=None):
+    """渲染热力图并返回 (文件名, 内容的hash)
+
+    文件名就是内容的hash，内容没有变化时不重新写入；写入新文件时删除旧的热力图。
+    """
+    folder = folder or OUT_FOLDER
+    content = render_heatmap(readTimes).encode("utf-8")
+    digest = hashlib.md5(content).hexdigest()
+    file_name = f"{digest}.svg"
+    path = os.path.join(folder, file_name)
+    if not os.path.exists(path):
+        os.makedirs(folder, exist_ok=True)
+        for entry in os.listdir(folder):
+            if entry.endswith(".svg"):
+                os.remove(os.path.join(folder, entry))
+        with open(path, "wb") as f:
+            f.write(content)
+        print(f"热力图已保存到{path}")
+    return file_name, digest
+
+
+def get_heatmap_file(folder=None):
+    """OUT_FOLDER中最新生成的热力图，文件名就是内容的hash"""
+    folder = folder or OUT_FOLDER
+    if not os.path.isdir(folder):
+        return None
+    entries = [x for x in os.listdir(folder) if x.endswith(".svg")]
+    if not entries:
+        return None
+    return max(entries, key=lambda x: os.path.getmtime(os.path.join(folder, x)))
+
+
+def publish_heatmap(notion_helper, folder=None):
+    """热力图已经推送到仓库后，把Notion中的热力图指向它，内容没有变化时不更新"""
+    file_name = get_heatmap_file(folder)
+    if file_name is None:
+        print(f"更新热力图失败，没有生成热力图。具体参考：{HEATMAP_GUIDE}")
+        return
+    if not notion_helper.heatmap_block_id:
+        print(f"更新热力图失败，没有添加热力图占位。具体参考：{HEATMAP_GUIDE}")
+        return
+    if not os.getenv("REPOSITORY") or not os.getenv("REF"):
+        print("没有设置REPOSITORY和REF，跳过更新热力图")
+        return
+    digest = os.path.splitext(file_name)[0]
+    state_key = f"heatmap:{notion_helper.heatmap_block_id}"
+    if notion_helper.sync_state.get_value(state_key) == digest:
+        print("热力图没有变化，跳过更新")
+        return
+    image_url = f"https://raw.githubusercontent.com/{os.getenv('REPOSITORY')}/{os.getenv('REF').split('/')[-1]}/OUT_FOLDER/{file_name}"
+    heatmap_url = f"https://heatmap.malinkang.com/?image={image_url}"
+    notion_helper.update_heatmap(block_id=notion_helper.heatmap_block_id, url=heatmap_url)
+    notion_helper.sync_state.set_value(state_key, digest)
+
+
+def main():
+    publish_heatmap(NotionHelper())
+
+
+if __name__ == "__main__":
+    main()
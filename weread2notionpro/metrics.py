@@ -0,0 +1,181 @@
+"""按接口统计请求次数、流量、重试、限流和耗时，运行结束时保存
+
+METRICS_PATH 为JSON汇总的路径，默认metrics.json，设置为空字符串时不保存；
+设置 METRICS_PROMETHEUS_PATH 时另外写入node exporter可以读取的textfile。
+"""
+import atexit
+import json
+import os
+import re
+import threading
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+from dotenv import load_dotenv
+from retrying import retry
+
+load_dotenv()
+
+ID_PATTERN = re.compile(r"^([0-9a-f-]{32,36}|\d+|[0-9a-zA-Z_]{20,})$")
+# 耗时直方图的区间上限（秒）
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PERCENTILES = (50, 90, 99)
+
+
+def get_route(method, url):
+    """把路径中的ID替换成:id，用来按接口统计"""
+    segments = [
+        ":id" if ID_PATTERN.match(segment) else segment
+        for segment in urlsplit(url).path.split("/")
+    ]
+    return f"{method.upper()} {'/'.join(segments)}"
+
+
+def get_percentile(values, percentile):
+    """values已经排好序，使用最近秩法"""
+    if not values:
+        return None
+    index = max(0, -(-len(values) * percentile // 100) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+class EndpointStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.bytes = 0
+        self.latencies = []
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = defaultdict(EndpointStats)
+        # 每个线程最后请求的接口，重试时计入这个接口
+        self.local = threading.local()
+
+    def record(self, service, route, latency, ok=True):
+        if not hasattr(self.local, "routes"):
+            self.local.routes = {}
+        self.local.routes[service] = route
+        with self.lock:
+            stats = self.endpoints[(service, route)]
+            stats.count += 1
+            stats.latencies.append(latency)
+            if not ok:
+                stats.errors += 1
+
+    def record_bytes(self, service, route, size):
+        with self.lock:
+            self.endpoints[(service, route)].bytes += size
+
+    def get_last_route(self, service):
+        return getattr(self.local, "routes", {}).get(service, "unknown")
+
+    def record_rate_limited(self, service, route):
+        """只记录被限流，是否重试由调用方决定，重试由counted_retry记录"""
+        with self.lock:
+            self.endpoints[(service, route)].rate_limited += 1
+
+    def record_retry(self, service, route, rate_limited=False):
+        with self.lock:
+            stats = self.endpoints[(service, route)]
+            stats.retries += 1
+            if rate_limited:
+                stats.rate_limited += 1
+
+    def summary(self):
+        """返回 {service: {route: {...}}}"""
+        result = defaultdict(dict)
+        with self.lock:
+            for (service, route), stats in sorted(self.endpoints.items()):
+                latencies = sorted(stats.latencies)
+                item = {
+                    "count": stats.count,
+                    "errors": stats.errors,
+                    "retries": stats.retries,
+                    "rate_limited": stats.rate_limited,
+                    "bytes": stats.bytes,
+                    "latency_total": round(sum(latencies), 3),
+                    "latency_max": round(latencies[-1], 3) if latencies else None,
+                }
+                for percentile in PERCENTILES:
+                    value = get_percentile(latencies, percentile)
+                    item[f"latency_p{percentile}"] = (
+                        round(value, 3) if value is not None else None
+                    )
+                result[service][route] = item
+        return dict(result)
+
+    def to_prometheus(self):
+        lines = []
+        counters = (
+            ("requests_total", "请求次数", "count"),
+            ("errors_total", "失败的请求次数", "errors"),
+            ("retries_total", "重试次数", "retries"),
+            ("rate_limited_total", "被限流的次数", "rate_limited"),
+            ("response_bytes_total", "返回内容的字节数", "bytes"),
+        )
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            for name, help, field in counters:
+                lines.append(f"# HELP weread2notion_{name} {help}")
+                lines.append(f"# TYPE weread2notion_{name} counter")
+                for (service, route), stats in endpoints:
+                    labels = get_labels(service, route)
+                    lines.append(f"weread2notion_{name}{{{labels}}} {getattr(stats, field)}")
+            name = "weread2notion_request_duration_seconds"
+            lines.append(f"# HELP {name} 请求耗时")
+            lines.append(f"# TYPE {name} histogram")
+            for (service, route), stats in endpoints:
+                labels = get_labels(service, route)
+                for bucket in BUCKETS:
+                    count = sum(1 for x in stats.latencies if x <= bucket)
+                    lines.append(f'{name}_bucket{{{labels},le="{bucket}"}} {count}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {len(stats.latencies)}')
+                lines.append(f"{name}_sum{{{labels}}} {sum(stats.latencies):.6f}")
+                lines.append(f"{name}_count{{{labels}}} {len(stats.latencies)}")
+        return "\n".join(lines) + "\n"
+
+    def save(self):
+        if not self.endpoints:
+            return
+        path = os.getenv("METRICS_PATH", "metrics.json")
+        if path:
+            with open(path, "w") as f:
+                json.dump(self.summary(), f, ensure_ascii=False, indent=4)
+            print(f"请求统计已保存到{path}")
+        prometheus_path = os.getenv("METRICS_PROMETHEUS_PATH")
+        if prometheus_path:
+            # 先写临时文件再重命名，避免node exporter读到写了一半的文件
+            tmp_path = f"{prometheus_path}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(self.to_prometheus())
+            os.replace(tmp_path, prometheus_path)
+
+
+def counted_retry(service):
+    """返回和retrying.retry用法一样的装饰器，每次重试计入service中最后请求的接口"""
+
+    def decorator(**kwargs):
+        wait_fixed = kwargs.pop("wait_fixed", 0)
+
+        def wait(attempt_number, delay_since_first_attempt_ms):
+            # 只有确定要重试时retrying才会调用，最后一次失败不计入
+            metrics.record_retry(service, metrics.get_last_route(service))
+            return wait_fixed
+
+        return retry(wait_func=wait, **kwargs)
+
+    return decorator
+
+
+def get_labels(service, route):
+    route = route.replace("\\", "\\\\").replace('"', '\\"')
+    return f'service="{service}",endpoint="{route}"'
+
+
+metrics = Metrics()
+atexit.register(metrics.save)
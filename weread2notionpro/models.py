@@ -0,0 +1,146 @@
+from dataclasses import dataclass
+from typing import ClassVar, Optional
+
+from weread2notionpro.sync_state import BOOKMARK, CHAPTER, REVIEW
+
+
+@dataclass(slots=True)
+class Bookmark:
+    """划线，只保留同步需要的字段"""
+
+    kind: ClassVar[str] = BOOKMARK
+    bookmark_id: str
+    book_id: Optional[str] = None
+    chapter_uid: Optional[int] = None
+    range: Optional[str] = None
+    mark_text: str = ""
+    create_time: Optional[int] = None
+    book_version: Optional[int] = None
+    color_style: Optional[int] = None
+    style: Optional[int] = None
+    type: Optional[int] = None
+    review_id: Optional[str] = None
+    # 插入到页面后的块ID
+    block_id: Optional[str] = None
+    # 内容没有变化的笔记，只作为插入位置
+    anchor: bool = False
+
+    @property
+    def note_id(self):
+        return self.bookmark_id
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            bookmark_id=data.get("bookmarkId"),
+            book_id=data.get("bookId"),
+            chapter_uid=data.get("chapterUid"),
+            range=data.get("range"),
+            mark_text=data.get("markText", ""),
+            create_time=data.get("createTime"),
+            book_version=data.get("bookVersion"),
+            color_style=data.get("colorStyle"),
+            style=data.get("style"),
+            type=data.get("type"),
+            review_id=data.get("reviewId"),
+        )
+
+
+@dataclass(slots=True)
+class Review:
+    """笔记和点评"""
+
+    kind: ClassVar[str] = REVIEW
+    review_id: str
+    book_id: Optional[str] = None
+    chapter_uid: Optional[int] = None
+    range: Optional[str] = None
+    content: str = ""
+    abstract: Optional[str] = None
+    create_time: Optional[int] = None
+    book_version: Optional[int] = None
+    star: Optional[int] = None
+    type: Optional[int] = None
+    block_id: Optional[str] = None
+    anchor: bool = False
+
+    @property
+    def note_id(self):
+        return self.review_id
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            review_id=data.get("reviewId"),
+            book_id=data.get("bookId"),
+            chapter_uid=data.get("chapterUid"),
+            range=data.get("range"),
+            content=data.get("content", ""),
+            abstract=data.get("abstract"),
+            create_time=data.get("createTime"),
+            book_version=data.get("bookVersion"),
+            star=data.get("star"),
+            type=data.get("type"),
+        )
+
+
+@dataclass(slots=True)
+class Chapter:
+    """章节，作为标题插入到笔记前面"""
+
+    kind: ClassVar[str] = CHAPTER
+    chapter_uid: int
+    chapter_idx: Optional[int] = None
+    update_time: Optional[int] = None
+    read_ahead: Optional[int] = None
+    title: Optional[str] = None
+    level: Optional[int] = None
+    block_id: Optional[str] = None
+    anchor: bool = False
+
+    @property
+    def note_id(self):
+        return str(self.chapter_uid)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            chapter_uid=data.get("chapterUid"),
+            chapter_idx=data.get("chapterIdx"),
+            update_time=data.get("updateTime"),
+            read_ahead=data.get("readAhead"),
+            title=data.get("title"),
+            level=data.get("level"),
+        )
+
+    def to_dict(self):
+        """转换成微信读书返回的格式，用来保存到本地状态"""
+        return {
+            "chapterUid": self.chapter_uid,
+            "chapterIdx": self.chapter_idx,
+            "updateTime": self.update_time,
+            "readAhead": self.read_ahead,
+            "title": self.title,
+            "level": self.level,
+        }
+
+
+@dataclass(slots=True)
+class BookProgress:
+    """书架中每本书的阅读进度"""
+
+    book_id: str
+    progress: Optional[int] = None
+    reading_time: Optional[int] = None
+    chapter_uid: Optional[int] = None
+    update_time: Optional[int] = None
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            book_id=data.get("bookId"),
+            progress=data.get("progress"),
+            reading_time=data.get("readingTime"),
+            chapter_uid=data.get("chapterUid"),
+            update_time=data.get("updateTime"),
+        )
@@ -1,21 +1,25 @@
 import logging
 import os
 import re
+import threading
 import time
 
-from notion_client import Client
+import httpx
+from notion_client import APIErrorCode, APIResponseError, Client
+from notion_client.errors import HTTPResponseError, RequestTimeoutError
 import pendulum
-from retrying import retry
-from datetime import timedelta
 from dotenv import load_dotenv
 
 load_dotenv()
+from weread2notionpro.block_diff import get_block_hash
+from weread2notionpro.concurrency import AdaptiveRateLimiter, ordered_map
+from weread2notionpro.date_dimension import get_calendar_day, get_days
+from weread2notionpro.metrics import counted_retry, get_route, metrics
+from weread2notionpro.replay import get_httpx_client
+from weread2notionpro.sync_state import SyncState
 from weread2notionpro.utils  import (
     format_date,
     get_date,
-    get_first_and_last_day_of_month,
-    get_first_and_last_day_of_week,
-    get_first_and_last_day_of_year,
     get_icon,
     get_number,
     get_relation,
@@ -25,10 +29,86 @@ from weread2notionpro.utils  import (
     get_property_value,
 )
 
+# 和retrying.retry用法一样，重试次数计入请求统计
+retry = counted_retry("notion")
 TAG_ICON_URL = "https://www.notion.so/icons/tag_gray.svg"
 USER_ICON_URL = "https://www.notion.so/icons/user-circle-filled_gray.svg"
 TARGET_ICON_URL = "https://www.notion.so/icons/target_red.svg"
 BOOKMARK_ICON_URL = "https://www.notion.so/icons/bookmark_gray.svg"
+# Notion平均每秒允许3次请求
+NOTION_RATE_LIMIT = float(os.getenv("NOTION_RATE_LIMIT", 3))
+# 被限流后最多重试的次数
+MAX_RATE_LIMITED_RETRIES = 10
+# 同时请求Notion的线程数，速率由限流器控制
+NOTION_CONCURRENCY = int(os.getenv("NOTION_CONCURRENCY", 3))
+# 插入笔记记录最多尝试的次数
+MAX_CREATE_ATTEMPTS = 3
+# 书架数据库需要的字段和类型，缺少时自动添加
+BOOK_DATABASE_PROPERTIES = {
+    "阅读时长": "number",
+    "书架分类": "select",
+    "豆瓣链接": "url",
+    "我的评分": "select",
+    "豆瓣短评": "rich_text",
+}
+# 书架数据库的字段检查过后，这段时间（秒）内不再检查
+SCHEMA_TTL = int(os.getenv("SCHEMA_TTL", 24 * 3600))
+# 设置读取过后，这段时间（秒）内直接使用本地缓存，也不更新最后同步时间
+SETTINGS_TTL = int(os.getenv("SETTINGS_TTL", 6 * 3600))
+# 本地关联缓存超过这个时间（秒）没有检查过，使用前先确认页面还存在
+RELATION_VALIDATE_TTL = int(os.getenv("RELATION_VALIDATE_TTL", 7 * 24 * 3600))
+
+
+def is_transient_error(e):
+    """限流、服务端错误和网络错误可以重试，参数错误等重试也不会成功"""
+    if isinstance(e, HTTPResponseError):
+        return e.status == 429 or e.status >= 500
+    return isinstance(e, (RequestTimeoutError, httpx.TransportError))
+
+
+def get_plain_text(data):
+    """块的文字内容，Notion返回的块有plain_text，本地生成的块只有text.content"""
+    return "".join(
+        x.get("plain_text") or x.get("text", {}).get("content", "")
+        for x in (data or {}).get("rich_text", [])
+    )
+
+
+class RateLimitedClient(Client):
+    """所有请求经过同一个限流器，被限流时按Retry-After等待后重试"""
+
+    def __init__(self, rate_limiter, **kwargs):
+        super().__init__(**kwargs)
+        self.rate_limiter = rate_limiter
+        self.client.event_hooks["response"].append(self.record_bytes)
+
+    def record_bytes(self, response):
+        response.read()
+        route = get_route(response.request.method, str(response.request.url))
+        metrics.record_bytes("notion", route, len(response.content))
+
+    def request(self, path, method, query=None, body=None, auth=None):
+        retries = 0
+        route = get_route(method, f"/v1/{path}")
+        while True:
+            self.rate_limiter.acquire()
+            started_at = time.monotonic()
+            try:
+                response = super().request(path, method, query, body, auth)
+            except APIResponseError as e:
+                metrics.record("notion", route, time.monotonic() - started_at, ok=False)
+                if e.code != APIErrorCode.RateLimited or retries >= MAX_RATE_LIMITED_RETRIES:
+                    raise
+                retries += 1
+                metrics.record_retry("notion", route, rate_limited=True)
+                self.rate_limiter.backoff(float(e.headers.get("Retry-After", 1)))
+                continue
+            except Exception:
+                metrics.record("notion", route, time.monotonic() - started_at, ok=False)
+                raise
+            metrics.record("notion", route, time.monotonic() - started_at)
+            self.rate_limiter.recover()
+            return response
 
 
 class NotionHelper:
@@ -52,8 +132,20 @@ class NotionHelper:
     block_type = "callout"
     sync_bookmark = True
     def __init__(self):
-        self.client = Client(auth=os.getenv("NOTION_TOKEN"), log_level=logging.ERROR)
+        self.client = RateLimitedClient(
+            AdaptiveRateLimiter(NOTION_RATE_LIMIT),
+            client=get_httpx_client(),
+            auth=os.getenv("NOTION_TOKEN"),
+            log_level=logging.ERROR,
+        )
         self.__cache = {}
+        self.sync_state = SyncState()
+        self.sync_state.evict_relations()
+        # 已经完整读取到__cache中的数据库
+        self.indexed_database_ids = set()
+        self.relation_lock = threading.RLock()
+        # 块ID到父块ID，父级是页面时为None，用来确定插入位置
+        self.block_parents = {}
         self.page_id = self.extract_page_id(os.getenv("NOTION_PAGE"))
         self.search_database(self.page_id)
         for key in self.database_name_dict.keys():
@@ -115,9 +207,59 @@ class NotionHelper:
             raise Exception(f"获取NotionID失败，请检查输入的Url是否正确")
 
     def search_database(self, block_id):
-        children = self.client.blocks.children.list(block_id=block_id)["results"]
-        # 遍历子块
-        for child in children:
+        """查找页面中的数据库和热力图，根页面没有修改过时直接使用上次的结果"""
+        key = f"databases:{block_id}"
+        last_edited_time = self.client.pages.retrieve(page_id=block_id).get(
+            "last_edited_time"
+        )
+        cached = self.sync_state.get_value(key)
+        if cached and cached.get("last_edited_time") == last_edited_time:
+            self.database_id_dict.update(cached.get("databases"))
+            self.heatmap_block_id = cached.get("heatmap_block_id")
+            return
+        print("正在查找页面中的数据库...")
+        tree = self.get_block_tree(block_id)
+        self.walk_block_tree(tree, block_id)
+        self.sync_state.set_value(
+            key,
+            {
+                "last_edited_time": last_edited_time,
+                "databases": self.database_id_dict,
+                "heatmap_block_id": self.heatmap_block_id,
+            },
+        )
+
+    def get_block_tree(self, block_id):
+        """逐层并发获取所有子块，返回 {块ID: 子块列表}"""
+        tree = {}
+        level = [block_id]
+        while level:
+            next_level = []
+            for id, children in ordered_map(
+                self.list_all_children, level, NOTION_CONCURRENCY
+            ):
+                tree[id] = children
+                next_level.extend(x["id"] for x in children if x.get("has_children"))
+            level = next_level
+        return tree
+
+    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    def list_all_children(self, block_id):
+        """分页获取块的所有子块"""
+        results = []
+        start_cursor = None
+        while True:
+            response = self.client.blocks.children.list(
+                block_id=block_id, start_cursor=start_cursor, page_size=100
+            )
+            results.extend(response.get("results"))
+            if not response.get("has_more"):
+                return results
+            start_cursor = response.get("next_cursor")
+
+    def walk_block_tree(self, tree, block_id):
+        """和逐个请求时一样按深度优先的顺序处理，重名的数据库以后出现的为准"""
+        for child in tree.get(block_id, []):
             # 检查子块的类型
             if child["type"] == "child_database":
                 self.database_id_dict[child.get("child_database").get("title")] = (
@@ -128,42 +270,69 @@ class NotionHelper:
                     self.heatmap_block_id = child.get("id")
             # 如果子块有子块，递归调用函数
             if "has_children" in child and child["has_children"]:
-                self.search_database(child["id"])
+                self.walk_block_tree(tree, child["id"])
+
+    def repair_book_database(self, e):
+        """书架数据库的字段可能在Notion中被删除或修改了类型，参数错误时不再使用缓存，重新检查字段"""
+        if isinstance(e, APIResponseError) and e.code == APIErrorCode.ValidationError:
+            self.sync_state.delete_value(f"schema:{self.book_database_id}")
+            self.update_book_database()
 
     def update_book_database(self):
-        """更新数据库"""
+        """更新数据库，需要的字段没有变化时在SCHEMA_TTL内不再检查"""
+        key = f"schema:{self.book_database_id}"
+        fingerprint = get_block_hash(BOOK_DATABASE_PROPERTIES)
+        cached = self.sync_state.get_value(key)
+        now = int(time.time())
+        if (
+            cached
+            and cached.get("fingerprint") == fingerprint
+            and now - cached.get("checked_at") < SCHEMA_TTL
+        ):
+            return
         response = self.client.databases.retrieve(database_id=self.book_database_id)
         id = response.get("id")
         properties = response.get("properties")
         update_properties = {}
-        if (
-            properties.get("阅读时长") is None
-            or properties.get("阅读时长").get("type") != "number"
-        ):
-            update_properties["阅读时长"] = {"number": {}}
-        if (
-            properties.get("书架分类") is None
-            or properties.get("书架分类").get("type") != "select"
-        ):
-            update_properties["书架分类"] = {"select": {}}
-        if (
-            properties.get("豆瓣链接") is None
-            or properties.get("豆瓣链接").get("type") != "url"
-        ):
-            update_properties["豆瓣链接"] = {"url": {}}
-        if (
-            properties.get("我的评分") is None
-            or properties.get("我的评分").get("type") != "select"
-        ):
-            update_properties["我的评分"] = {"select": {}}
-        if (
-            properties.get("豆瓣短评") is None
-            or properties.get("豆瓣短评").get("type") != "rich_text"
-        ):
-            update_properties["豆瓣短评"] = {"rich_text": {}}
+        for name, type in BOOK_DATABASE_PROPERTIES.items():
+            if properties.get(name) is None or properties.get(name).get("type") != type:
+                update_properties[name] = {type: {}}
         """NeoDB先不添加了，现在受众还不广，可能有的小伙伴不知道是干什么的"""
         if len(update_properties) > 0:
             self.client.databases.update(database_id=id, properties=update_properties)
+        self.sync_state.set_value(key, {"fingerprint": fingerprint, "checked_at": now})
+
+    def ensure_number_properties(self, database_id, names):
+        """添加缺少的数字属性，返回可以写入的属性，同名但不是数字类型的属性不修改"""
+        key = f"number_properties:{database_id}"
+        fingerprint = get_block_hash(sorted(names))
+        cached = self.sync_state.get_value(key)
+        now = int(time.time())
+        if (
+            cached
+            and cached.get("fingerprint") == fingerprint
+            and now - cached.get("checked_at") < SCHEMA_TTL
+        ):
+            return cached.get("names")
+        properties = self.client.databases.retrieve(database_id=database_id).get(
+            "properties"
+        )
+        missing = [name for name in names if name not in properties]
+        if missing:
+            self.client.databases.update(
+                database_id=database_id,
+                properties={name: {"number": {}} for name in missing},
+            )
+        usable = []
+        for name in names:
+            if name in missing or properties.get(name).get("type") == "number":
+                usable.append(name)
+            else:
+                print(f"属性{name}已经存在并且不是数字类型，跳过")
+        self.sync_state.set_value(
+            key, {"fingerprint": fingerprint, "checked_at": now, "names": usable}
+        )
+        return usable
 
     def create_database(self):
         title = [
@@ -240,6 +409,22 @@ class NotionHelper:
         ).get("id")
 
     def insert_to_setting_database(self):
+        """读取设置并更新最后同步时间，写入的内容没有变化时在SETTINGS_TTL内使用本地缓存"""
+        key = f"settings:{self.setting_database_id}"
+        fingerprint = get_block_hash(
+            [os.getenv("NOTION_TOKEN"), os.getenv("NOTION_PAGE"), os.getenv("WEREAD_COOKIE")]
+        )
+        cached = self.sync_state.get_value(key)
+        now = int(time.time())
+        if (
+            cached
+            and cached.get("fingerprint") == fingerprint
+            and now - cached.get("checked_at") < SETTINGS_TTL
+        ):
+            self.show_color = cached.get("show_color")
+            self.sync_bookmark = cached.get("sync_bookmark")
+            self.block_type = cached.get("block_type")
+            return
         existing_pages = self.query(database_id=self.setting_database_id, filter={"property": "标题", "title": {"equals": "设置"}}).get("results")
         properties = {
             "标题": {"title": [{"type": "text", "text": {"content": "设置"}}]},
@@ -263,6 +448,16 @@ class NotionHelper:
                 parent={"database_id": self.setting_database_id},
                 properties=properties,
             )
+        self.sync_state.set_value(
+            key,
+            {
+                "fingerprint": fingerprint,
+                "checked_at": now,
+                "show_color": self.show_color,
+                "sync_bookmark": self.sync_bookmark,
+                "block_type": self.block_type,
+            },
+        )
   
         
 
@@ -271,138 +466,214 @@ class NotionHelper:
         return self.client.blocks.update(block_id=block_id, embed={"url": url})
 
     def get_week_relation_id(self, date):
-        year = date.isocalendar().year
-        week = date.isocalendar().week
-        week = f"{year}年第{week}周"
-        start, end = get_first_and_last_day_of_week(date)
-        properties = {"日期": get_date(format_date(start), format_date(end))}
-        return self.get_relation_id(
-            week, self.week_database_id, TARGET_ICON_URL, properties
-        )
+        day = get_calendar_day(date)
+        if day.week_id is None:
+            properties = {
+                "日期": get_date(format_date(day.week_start), format_date(day.week_end))
+            }
+            day.week_id = self.get_relation_id(
+                day.week_key, self.week_database_id, TARGET_ICON_URL, properties
+            )
+        return day.week_id
 
     def get_month_relation_id(self, date):
-        month = date.strftime("%Y年%-m月")
-        start, end = get_first_and_last_day_of_month(date)
-        properties = {"日期": get_date(format_date(start), format_date(end))}
-        return self.get_relation_id(
-            month, self.month_database_id, TARGET_ICON_URL, properties
-        )
+        day = get_calendar_day(date)
+        if day.month_id is None:
+            properties = {
+                "日期": get_date(format_date(day.month_start), format_date(day.month_end))
+            }
+            day.month_id = self.get_relation_id(
+                day.month_key, self.month_database_id, TARGET_ICON_URL, properties
+            )
+        return day.month_id
 
     def get_year_relation_id(self, date):
-        year = date.strftime("%Y")
-        start, end = get_first_and_last_day_of_year(date)
-        properties = {"日期": get_date(format_date(start), format_date(end))}
-        return self.get_relation_id(
-            year, self.year_database_id, TARGET_ICON_URL, properties
-        )
+        day = get_calendar_day(date)
+        if day.year_id is None:
+            properties = {
+                "日期": get_date(format_date(day.year_start), format_date(day.year_end))
+            }
+            day.year_id = self.get_relation_id(
+                day.year_key, self.year_database_id, TARGET_ICON_URL, properties
+            )
+        return day.year_id
 
     def get_day_relation_id(self, date):
-        new_date = date.replace(hour=0, minute=0, second=0, microsecond=0)
-        timestamp = (new_date - timedelta(hours=8)).timestamp()
-        day = new_date.strftime("%Y年%m月%d日")
-        properties = {
-            "日期": get_date(format_date(date)),
-            "时间戳": get_number(timestamp),
-        }
-        properties["年"] = get_relation(
-            [
-                self.get_year_relation_id(new_date),
-            ]
-        )
-        properties["月"] = get_relation(
-            [
-                self.get_month_relation_id(new_date),
-            ]
-        )
-        properties["周"] = get_relation(
-            [
-                self.get_week_relation_id(new_date),
-            ]
-        )
-        return self.get_relation_id(
-            day, self.day_database_id, TARGET_ICON_URL, properties
-        )
+        day = get_calendar_day(date)
+        if day.day_id is None:
+            properties = {
+                "日期": get_date(format_date(day.date)),
+                "时间戳": get_number(day.timestamp),
+                "年": get_relation([self.get_year_relation_id(day)]),
+                "月": get_relation([self.get_month_relation_id(day)]),
+                "周": get_relation([self.get_week_relation_id(day)]),
+            }
+            day.day_id = self.get_relation_id(
+                day.title, self.day_database_id, TARGET_ICON_URL, properties
+            )
+        return day.day_id
 
     def get_relation_id(self, name, id, icon, properties={}):
         key = f"{id}{name}"
         if key in self.__cache:
             return self.__cache.get(key)
-        filter = {"property": "标题", "title": {"equals": name}}
-        response = self.client.databases.query(database_id=id, filter=filter)
-        if len(response.get("results")) == 0:
-            parent = {"database_id": id, "type": "database_id"}
-            properties["标题"] = get_title(name)
-            page_id = self.client.pages.create(
-                parent=parent, properties=properties, icon=get_icon(icon)
-            ).get("id")
-        else:
-            page_id = response.get("results")[0].get("id")
-        self.__cache[key] = page_id
+        with self.relation_lock:
+            if key in self.__cache:
+                return self.__cache.get(key)
+            page_id = self.get_persisted_relation_id(id, name)
+            if page_id:
+                self.__cache[key] = page_id
+                return page_id
+            if id in self.get_date_database_ids():
+                self.load_relation_index(id)
+            if key in self.__cache:
+                return self.__cache.get(key)
+            results = []
+            # 本次运行已经完整读取过的数据库中没有，说明不存在，不用再查询
+            if id not in self.indexed_database_ids:
+                filter = {"property": "标题", "title": {"equals": name}}
+                response = self.client.databases.query(database_id=id, filter=filter)
+                results = response.get("results")
+            if len(results) == 0:
+                parent = {"database_id": id, "type": "database_id"}
+                properties["标题"] = get_title(name)
+                page_id = self.client.pages.create(
+                    parent=parent, properties=properties, icon=get_icon(icon)
+                ).get("id")
+            else:
+                page_id = results[0].get("id")
+            self.__cache[key] = page_id
+            self.sync_state.put_relations(id, {name: page_id}, int(time.time()))
+            return page_id
+
+    def get_persisted_relation_id(self, database_id, name):
+        """从本地关联缓存中获取页面ID，超过RELATION_VALIDATE_TTL没有检查过的先确认页面没有被删除"""
+        row = self.sync_state.get_relation(database_id, name)
+        if row is None:
+            return None
+        page_id, validated_at = row
+        now = int(time.time())
+        if now - (validated_at or 0) < RELATION_VALIDATE_TTL:
+            self.sync_state.touch_relation(database_id, name, now)
+            return page_id
+        try:
+            page = self.client.pages.retrieve(page_id=page_id)
+        except APIResponseError as e:
+            if e.code != APIErrorCode.ObjectNotFound:
+                raise
+            page = None
+        if page is None or page.get("archived") or page.get("in_trash"):
+            self.sync_state.delete_relation(database_id, name)
+            return None
+        self.sync_state.touch_relation(database_id, name, now, now)
         return page_id
 
+    def get_date_database_ids(self):
+        return (
+            self.year_database_id,
+            self.month_database_id,
+            self.week_database_id,
+            self.day_database_id,
+        )
+
+    def load_relation_index(self, database_id):
+        """分页读取整个数据库，按标题缓存页面ID，之前的运行已经读取过的不再重复读取"""
+        if database_id in self.indexed_database_ids:
+            return
+        if self.sync_state.get_value(f"indexed:{database_id}"):
+            return
+        results = self.query_all(database_id)
+        relations = {}
+        for result in results:
+            name = get_property_value(result.get("properties").get("标题"))
+            if name:
+                relations.setdefault(name, result.get("id"))
+        for name, page_id in relations.items():
+            self.__cache.setdefault(f"{database_id}{name}", page_id)
+        self.sync_state.put_relations(database_id, relations, int(time.time()))
+        self.sync_state.set_value(f"indexed:{database_id}", True)
+        self.indexed_database_ids.add(database_id)
+        print(f"已读取{len(results)}条日期数据")
+
+    def ensure_date_relations(self, timestamps, with_day=True):
+        """按年、月、周、日的顺序提前解析一批时间戳的日期关联，缺少的页面提前创建，之后插入时不再请求Notion"""
+        days = get_days(timestamps)
+        for day in {day.year_key: day for day in days}.values():
+            self.get_year_relation_id(day)
+        for day in {day.month_key: day for day in days}.values():
+            self.get_month_relation_id(day)
+        for day in {day.week_key: day for day in days}.values():
+            self.get_week_relation_id(day)
+        for day in days:
+            # 同一年、月、周的其他日期直接使用内存缓存
+            self.get_year_relation_id(day)
+            self.get_month_relation_id(day)
+            self.get_week_relation_id(day)
+            if with_day:
+                self.get_day_relation_id(day)
+        return days
+
     def insert_bookmark(self, id, bookmark):
         icon = get_icon(BOOKMARK_ICON_URL)
         properties = {
-            "Name": get_title(bookmark.get("markText", "")),
-            "bookId": get_rich_text(bookmark.get("bookId")),
-            "range": get_rich_text(bookmark.get("range")),
-            "bookmarkId": get_rich_text(bookmark.get("bookmarkId")),
-            "blockId": get_rich_text(bookmark.get("blockId")),
-            "chapterUid": get_number(bookmark.get("chapterUid")),
-            "bookVersion": get_number(bookmark.get("bookVersion")),
-            "colorStyle": get_number(bookmark.get("colorStyle")),
-            "type": get_number(bookmark.get("type")),
-            "style": get_number(bookmark.get("style")),
+            "Name": get_title(bookmark.mark_text),
+            "bookId": get_rich_text(bookmark.book_id),
+            "range": get_rich_text(bookmark.range),
+            "bookmarkId": get_rich_text(bookmark.bookmark_id),
+            "blockId": get_rich_text(bookmark.block_id),
+            "chapterUid": get_number(bookmark.chapter_uid),
+            "bookVersion": get_number(bookmark.book_version),
+            "colorStyle": get_number(bookmark.color_style),
+            "type": get_number(bookmark.type),
+            "style": get_number(bookmark.style),
             "书籍": get_relation([id]),
         }
-        if "createTime" in bookmark:
-            create_time = timestamp_to_date(int(bookmark.get("createTime")))
+        if bookmark.create_time is not None:
+            create_time = timestamp_to_date(int(bookmark.create_time))
             properties["Date"] = get_date(create_time.strftime("%Y-%m-%d %H:%M:%S"))
             self.get_date_relation(properties, create_time)
         parent = {"database_id": self.bookmark_database_id, "type": "database_id"}
-        self.create_page(parent, properties, icon)
+        return self.create_note_page(parent, properties, icon)
 
     def insert_review(self, id, review):
-        time.sleep(0.1)
         icon = get_icon(TAG_ICON_URL)
         properties = {
-            "Name": get_title(review.get("content", "")),
-            "bookId": get_rich_text(review.get("bookId")),
-            "reviewId": get_rich_text(review.get("reviewId")),
-            "blockId": get_rich_text(review.get("blockId")),
-            "chapterUid": get_number(review.get("chapterUid")),
-            "bookVersion": get_number(review.get("bookVersion")),
-            "type": get_number(review.get("type")),
+            "Name": get_title(review.content),
+            "bookId": get_rich_text(review.book_id),
+            "reviewId": get_rich_text(review.review_id),
+            "blockId": get_rich_text(review.block_id),
+            "chapterUid": get_number(review.chapter_uid),
+            "bookVersion": get_number(review.book_version),
+            "type": get_number(review.type),
             "书籍": get_relation([id]),
         }
-        if "range" in review:
-            properties["range"] = get_rich_text(review.get("range"))
-        if "star" in review:
-            properties["star"] = get_number(review.get("star"))
-        if "abstract" in review:
-            properties["abstract"] = get_rich_text(review.get("abstract"))
-        if "createTime" in review:
-            create_time = timestamp_to_date(int(review.get("createTime")))
+        if review.range is not None:
+            properties["range"] = get_rich_text(review.range)
+        if review.star is not None:
+            properties["star"] = get_number(review.star)
+        if review.abstract is not None:
+            properties["abstract"] = get_rich_text(review.abstract)
+        if review.create_time is not None:
+            create_time = timestamp_to_date(int(review.create_time))
             properties["Date"] = get_date(create_time.strftime("%Y-%m-%d %H:%M:%S"))
             self.get_date_relation(properties, create_time)
         parent = {"database_id": self.review_database_id, "type": "database_id"}
-        self.create_page(parent, properties, icon)
+        return self.create_note_page(parent, properties, icon)
 
     def insert_chapter(self, id, chapter):
-        time.sleep(0.1)
         icon = {"type": "external", "external": {"url": TAG_ICON_URL}}
         properties = {
-            "Name": get_title(chapter.get("title")),
-            "blockId": get_rich_text(chapter.get("blockId")),
-            "chapterUid": {"number": chapter.get("chapterUid")},
-            "chapterIdx": {"number": chapter.get("chapterIdx")},
-            "readAhead": {"number": chapter.get("readAhead")},
-            "updateTime": {"number": chapter.get("updateTime")},
-            "level": {"number": chapter.get("level")},
+            "Name": get_title(chapter.title),
+            "blockId": get_rich_text(chapter.block_id),
+            "chapterUid": {"number": chapter.chapter_uid},
+            "chapterIdx": {"number": chapter.chapter_idx},
+            "readAhead": {"number": chapter.read_ahead},
+            "updateTime": {"number": chapter.update_time},
+            "level": {"number": chapter.level},
             "书籍": {"relation": [{"id": id}]},
         }
         parent = {"database_id": self.chapter_database_id, "type": "database_id"}
-        self.create_page(parent, properties, icon)
+        return self.create_note_page(parent, properties, icon)
 
     @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def update_book_page(self, page_id, properties):
@@ -410,20 +681,49 @@ class NotionHelper:
 
     @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def update_page(self, page_id, properties, cover):
-        return self.client.pages.update(
-            page_id=page_id, properties=properties, cover=cover
-        )
+        try:
+            return self.client.pages.update(
+                page_id=page_id, properties=properties, cover=cover
+            )
+        except Exception as e:
+            self.repair_book_database(e)
+            raise
 
 
     @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def create_page(self, parent, properties, icon):
         return self.client.pages.create(parent=parent, properties=properties, icon=icon)
 
+    def create_note_page(self, parent, properties, icon):
+        """插入笔记记录，重试前先按blockId查询，超时但其实已经插入成功时不会重复插入"""
+        block_id = properties.get("blockId").get("rich_text")[0].get("text").get("content")
+        filter = {"property": "blockId", "rich_text": {"equals": block_id}}
+        for attempt in range(MAX_CREATE_ATTEMPTS):
+            try:
+                return self.client.pages.create(
+                    parent=parent, properties=properties, icon=icon
+                )
+            except Exception as e:
+                if attempt == MAX_CREATE_ATTEMPTS - 1 or not is_transient_error(e):
+                    raise
+                print(f"插入记录失败，5秒后重试: {e}")
+                metrics.record_retry("notion", "POST /v1/pages")
+                time.sleep(5)
+                results = self.query(
+                    database_id=parent.get("database_id"), filter=filter
+                ).get("results")
+                if results:
+                    return results[0]
+
     @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def create_book_page(self, parent, properties, icon):
-        return self.client.pages.create(
-            parent=parent, properties=properties, icon=icon, cover=icon
-        )
+        try:
+            return self.client.pages.create(
+                parent=parent, properties=properties, icon=icon, cover=icon
+            )
+        except Exception as e:
+            self.repair_book_database(e)
+            raise
 
     @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def query(self, **kwargs):
@@ -433,21 +733,76 @@ class NotionHelper:
     @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def get_block_children(self, id):
         response = self.client.blocks.children.list(id)
+        self.record_block_parents(response.get("results"))
         return response.get("results")
 
     @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def append_blocks(self, block_id, children):
-        return self.client.blocks.children.append(block_id=block_id, children=children)
+        response = self.client.blocks.children.append(block_id=block_id, children=children)
+        self.record_block_parents(response.get("results"))
+        return response
 
     @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def append_blocks_after(self, block_id, children, after):
-        #奇怪不知道为什么会多插入一个children，没找到问题，先暂时这么解决，搜索是否有parent
-        parent = self.client.blocks.retrieve(after).get("parent")
-        if(parent.get("type")=="block_id"):
-            after = parent.get("block_id")
-        return self.client.blocks.children.append(
-            block_id=block_id, children=children, after=after
+        response = self.client.blocks.children.append(
+            block_id=block_id, children=children, after=self.get_top_level_block(after)
         )
+        self.record_block_parents(response.get("results"))
+        return response
+
+    def record_block_parents(self, results):
+        """记录块的父块，父级是页面的块记为None"""
+        for result in results or []:
+            parent = result.get("parent") or {}
+            self.block_parents[result.get("id")] = (
+                parent.get("block_id") if parent.get("type") == "block_id" else None
+            )
+
+    def mark_top_level_blocks(self, block_ids):
+        """本地同步状态中记录的块都是直接插入到页面中的"""
+        for block_id in block_ids:
+            self.block_parents.setdefault(block_id, None)
+
+    def get_top_level_block(self, block_id):
+        """after必须是页面的直接子块，嵌套的块返回它的父块"""
+        #奇怪不知道为什么会多插入一个children，没找到问题，先暂时这么解决，搜索是否有parent
+        parent = self.sync_state.get_value(f"block_parent:{block_id}")
+        if parent:
+            return parent
+        if block_id not in self.block_parents:
+            parent = self.client.blocks.retrieve(block_id).get("parent")
+            self.record_block_parents([{"id": block_id, "parent": parent}])
+            if self.block_parents.get(block_id):
+                self.sync_state.set_value(
+                    f"block_parent:{block_id}", self.block_parents.get(block_id)
+                )
+        return self.block_parents.get(block_id) or block_id
+
+    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    def update_block(self, block_id, block):
+        """原地更新块的内容，块的类型不能修改，子块不能通过更新修改，单独同步"""
+        type = block.get("type")
+        data = {k: v for k, v in block.get(type).items() if k != "children"}
+        response = self.client.blocks.update(block_id=block_id, **{type: data})
+        children = block.get(type).get("children") or []
+        # 返回结果中的has_children是更新前的状态，原来和现在都没有子块时不需要查询
+        if children or response.get("has_children"):
+            self.update_block_children(block_id, children)
+        return response
+
+    def update_block_children(self, block_id, children):
+        """子块类型一致时逐个原地更新内容变化的子块，否则删除已有的子块后重新插入"""
+        current = self.client.blocks.children.list(block_id).get("results")
+        if [x.get("type") for x in current] != [x.get("type") for x in children]:
+            for child in current:
+                self.client.blocks.delete(block_id=child.get("id"))
+            if children:
+                self.client.blocks.children.append(block_id=block_id, children=children)
+            return
+        for old, new in zip(current, children):
+            type = new.get("type")
+            if get_plain_text(old.get(type)) != get_plain_text(new.get(type)):
+                self.client.blocks.update(block_id=old.get("id"), **{type: new.get(type)})
 
     @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def delete_block(self, block_id):
@@ -516,6 +871,7 @@ class NotionHelper:
         return results
 
     def get_date_relation(self, properties, date):
+        date = get_calendar_day(date)
         properties["年"] = get_relation(
             [
                 self.get_year_relation_id(date),
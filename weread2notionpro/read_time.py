@@ -1,102 +1,91 @@
-from datetime import datetime
-from datetime import timedelta
 import os
 import sys  # 添加sys模块用于异常处理
+import time
 
 import pendulum
 
+from weread2notionpro.date_dimension import build_calendar
+from weread2notionpro.heatmap import write_heatmap
+from weread2notionpro.rollup import PERIODS, ROLLUP_PROPERTIES, compute_rollups
 from weread2notionpro.weread_api import WeReadApi
+from weread2notionpro.block_diff import get_block_hash
 from weread2notionpro.notion_helper import NotionHelper
 from weread2notionpro.utils import (
     format_date,
     get_date,
-    get_icon,
     get_number,
     get_relation,
     get_title,
 )
 
 
-def insert_to_notion(page_id, timestamp, duration):
-    parent = {"database_id": notion_helper.day_database_id, "type": "database_id"}
+def insert_to_notion(page_id, timestamp, duration, day):
+    """day是timestamp对应的CalendarDay，年、月、周关联已经提前解析"""
+    if page_id is None:
+        # 和书架、笔记同时运行时可能同时需要同一天，通过关联缓存和锁获取或创建，避免重复创建
+        page_id = notion_helper.get_day_relation_id(day)
     properties = {
-        "标题": get_title(
-            format_date(
-                datetime.utcfromtimestamp(timestamp) + timedelta(hours=8),
-                "%Y年%m月%d日",
-            )
-        ),
-        "日期": get_date(
-            start=format_date(datetime.utcfromtimestamp(timestamp) + timedelta(hours=8))
-        ),
+        "标题": get_title(day.title),
+        "日期": get_date(start=format_date(day.date)),
         "时长": get_number(duration),
         "时间戳": get_number(timestamp),
-        "年": get_relation(
-            [
-                notion_helper.get_year_relation_id(
-                    datetime.utcfromtimestamp(timestamp) + timedelta(hours=8)
-                ),
-            ]
-        ),
-        "月": get_relation(
-            [
-                notion_helper.get_month_relation_id(
-                    datetime.utcfromtimestamp(timestamp) + timedelta(hours=8)
-                ),
-            ]
-        ),
-        "周": get_relation(
-            [
-                notion_helper.get_week_relation_id(
-                    datetime.utcfromtimestamp(timestamp) + timedelta(hours=8)
-                ),
-            ]
-        ),
+        "年": get_relation([notion_helper.get_year_relation_id(day)]),
+        "月": get_relation([notion_helper.get_month_relation_id(day)]),
+        "周": get_relation([notion_helper.get_week_relation_id(day)]),
     }
-    if page_id != None:
-        notion_helper.client.pages.update(page_id=page_id, properties=properties)
-    else:
-        notion_helper.client.pages.create(
-            parent=parent,
-            icon=get_icon("https://www.notion.so/icons/target_red.svg"),
-            properties=properties,
-        )
+    notion_helper.client.pages.update(page_id=page_id, properties=properties)
 
 
-def get_file():
-    # 设置文件夹路径
-    folder_path = "./OUT_FOLDER"
+def update_rollups(readTimes):
+    """按周、月、年汇总阅读时长，只更新汇总值变化的页面"""
+    rollups = compute_rollups(readTimes)
+    get_relation_ids = {
+        "year": notion_helper.get_year_relation_id,
+        "month": notion_helper.get_month_relation_id,
+        "week": notion_helper.get_week_relation_id,
+    }
+    for period in PERIODS:
+        database_id = getattr(notion_helper, f"{period}_database_id")
+        if database_id is None:
+            continue
+        names = notion_helper.ensure_number_properties(database_id, ROLLUP_PROPERTIES)
+        if not names:
+            continue
+        state_key = f"rollup:{database_id}"
+        fingerprints = notion_helper.sync_state.get_value(state_key, {})
+        changed = 0
+        for key, (values, day) in rollups.get(period).items():
+            properties = {name: get_number(values.get(name)) for name in names}
+            fingerprint = get_block_hash(properties)
+            if fingerprints.get(key) == fingerprint:
+                continue
+            page_id = get_relation_ids[period](day)
+            notion_helper.update_book_page(page_id=page_id, properties=properties)
+            fingerprints[key] = fingerprint
+            changed += 1
+        notion_helper.sync_state.set_value(state_key, fingerprints)
+        print(f"更新了{changed}个{period}汇总")
 
-    # 检查文件夹是否存在
-    if os.path.exists(folder_path) and os.path.isdir(folder_path):
-        entries = os.listdir(folder_path)
 
-        file_name = entries[0] if entries else None
-        return file_name
-    else:
-        print("OUT_FOLDER does not exist.")
-        return None
+# 微信读书可能会补充最近几天的阅读时长，水位线往前留出的天数
+READ_TIME_LOOKBACK_DAYS = int(os.getenv("READ_TIME_LOOKBACK_DAYS", 7))
+# 每隔多少天完整比较一次日数据库
+READ_TIME_FULL_SYNC_DAYS = int(os.getenv("READ_TIME_FULL_SYNC_DAYS", 7))
+
 
-HEATMAP_GUIDE = "https://mp.weixin.qq.com/s?__biz=MzI1OTcxOTI4NA==&mid=2247484145&idx=1&sn=81752852420b9153fc292b7873217651&chksm=ea75ebeadd0262fc65df100370d3f983ba2e52e2fcde2deb1ed49343fbb10645a77570656728&token=157143379&lang=zh_CN#rd"
+notion_helper = None
+weread_api = None
 
 
-notion_helper = NotionHelper()
-weread_api = WeReadApi()
+def init(api=None, helper=None):
+    """创建WeReadApi和NotionHelper，统一入口会传入共享的实例"""
+    global weread_api, notion_helper
+    notion_helper = helper or notion_helper or NotionHelper()
+    weread_api = api or weread_api or WeReadApi()
+
 
 def main():
-    image_file = get_file()
-    if image_file:
-        image_url = f"https://raw.githubusercontent.com/{os.getenv('REPOSITORY')}/{os.getenv('REF').split('/')[-1]}/OUT_FOLDER/{image_file}"
-        heatmap_url = f"https://heatmap.malinkang.com/?image={image_url}"
-        if notion_helper.heatmap_block_id:
-            response = notion_helper.update_heatmap(
-                block_id=notion_helper.heatmap_block_id, url=heatmap_url
-            )
-        else:
-            print(f"更新热力图失败，没有添加热力图占位。具体参考：{HEATMAP_GUIDE}")
-    else:
-        print(f"更新热力图失败，没有生成热力图。具体参考：{HEATMAP_GUIDE}")
-    
+    init()
     # 添加异常处理
     try:
         api_data = weread_api.get_api_data()
@@ -116,7 +105,25 @@ def main():
     if today_timestamp not in readTimes:
         readTimes[today_timestamp] = 0
     readTimes = dict(sorted(readTimes.items()))
-    results = notion_helper.query_all(database_id=notion_helper.day_database_id)
+    # 汇总需要完整的阅读数据，在按水位线过滤之前保留一份
+    all_read_times = dict(readTimes)
+    # 只生成SVG，推送到仓库后由heatmap模块更新Notion中的链接
+    write_heatmap(all_read_times)
+    state_key = f"read_time:{notion_helper.day_database_id}"
+    state = notion_helper.sync_state.get_value(state_key, {})
+    full_sync = time.time() - state.get("full_sync_at", 0) >= READ_TIME_FULL_SYNC_DAYS * 86400
+    if full_sync or not state.get("watermark"):
+        print("完整比较日数据库")
+        full_sync = True
+        results = notion_helper.query_all(database_id=notion_helper.day_database_id)
+    else:
+        # 水位线之前的数据已经同步过，只比较之后的
+        watermark = state.get("watermark")
+        readTimes = {k: v for k, v in readTimes.items() if k >= watermark}
+        filter = {"property": "时间戳", "number": {"greater_than_or_equal_to": watermark}}
+        results = notion_helper.query_all_by_book(notion_helper.day_database_id, filter)
+    watermark = max(readTimes) - READ_TIME_LOOKBACK_DAYS * 86400
+    updates = []
     for result in results:
         timestamp = result.get("properties").get("时间戳").get("number")
         duration = result.get("properties").get("时长").get("number")
@@ -124,9 +131,20 @@ def main():
         if timestamp in readTimes:
             value = readTimes.pop(timestamp)
             if value != duration:
-                insert_to_notion(page_id=id, timestamp=timestamp, duration=value)
-    for key, value in readTimes.items():
-        insert_to_notion(None, int(key), value)
+                updates.append((id, timestamp, value))
+    updates.extend((None, int(key), value) for key, value in readTimes.items())
+    # 日数据库就是这里要写入的，只需要提前准备年、月、周
+    calendar = build_calendar([timestamp for _, timestamp, _ in updates])
+    notion_helper.ensure_date_relations(calendar.keys(), with_day=False)
+    for id, timestamp, value in updates:
+        insert_to_notion(
+            page_id=id, timestamp=timestamp, duration=value, day=calendar.get(timestamp)
+        )
+    state["watermark"] = watermark
+    if full_sync:
+        state["full_sync_at"] = int(time.time())
+    notion_helper.sync_state.set_value(state_key, state)
+    update_rollups(all_read_times)
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,249 @@
+"""录制和回放微信读书、Notion的HTTP请求
+
+HTTP_REPLAY=record 时正常请求并把返回结果保存到 HTTP_REPLAY_DIR，
+HTTP_REPLAY=replay 时不访问网络，直接从录制的结果中返回。
+录制的结果包含书架和笔记内容，不要提交到公开的仓库。
+"""
+import atexit
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict, deque
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from weread2notionpro.metrics import get_route
+
+RECORD = "record"
+REPLAY = "replay"
+DEFAULT_REPLAY_DIR = "fixtures"
+# 回放时保留的响应头
+KEPT_HEADERS = ("content-type", "retry-after")
+
+
+def get_mode():
+    mode = os.getenv("HTTP_REPLAY", "").strip().lower()
+    return mode if mode in (RECORD, REPLAY) else None
+
+
+def get_replay_dir():
+    return os.getenv("HTTP_REPLAY_DIR") or DEFAULT_REPLAY_DIR
+
+
+def get_key(method, url, body):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    digest = hashlib.sha1(f"{method} {url}\n".encode("utf-8"))
+    digest.update(body or b"")
+    return digest.hexdigest()
+
+
+class Cassette:
+    """一个服务的录制结果，每行一个请求"""
+
+    def __init__(self, service, mode, path):
+        self.service = service
+        self.mode = mode
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = []
+        self.by_key = defaultdict(deque)
+        self.by_route = defaultdict(deque)
+        # 每个请求最后返回的记录
+        self.last = {}
+        self.counts = Counter()
+        self.misses = Counter()
+        # HTTP_REPLAY_LATENCY=true时按录制时的耗时等待，模拟真实的网络延迟
+        self.latency = os.getenv("HTTP_REPLAY_LATENCY", "false").lower() == "true"
+        if mode == REPLAY:
+            self.load()
+        else:
+            atexit.register(self.save)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            raise Exception(f"没有找到录制文件{self.path}，请先用HTTP_REPLAY=record运行一次")
+        with open(self.path) as f:
+            for line in f:
+                entry = json.loads(line)
+                self.by_key[entry["key"]].append(entry)
+                self.by_route[entry["route"]].append(entry)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self.lock, open(self.path, "w") as f:
+            for entry in self.entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def record(self, method, url, body, status, headers, content, elapsed):
+        route = get_route(method, url)
+        entry = {
+            "key": get_key(method, url, body),
+            "route": route,
+            "method": method,
+            "url": url,
+            "status": status,
+            "headers": {k: v for k, v in headers.items() if k.lower() in KEPT_HEADERS},
+            "body": content.decode("utf-8", errors="replace"),
+            "elapsed": elapsed,
+        }
+        with self.lock:
+            self.entries.append(entry)
+            self.counts[route] += 1
+
+    def take(self, entries):
+        """返回第一个没有使用过的记录并标记为已使用，两个索引共享同一个记录"""
+        while entries and entries[0].get("used"):
+            entries.popleft()
+        if not entries:
+            return None
+        entry = entries.popleft()
+        entry["used"] = True
+        return entry
+
+    def play(self, method, url, body):
+        """每条录制的结果只返回一次，按录制顺序优先返回完全相同的请求，其次同一接口的请求
+
+        完全相同的请求比录制时多时，重复返回这个请求最后一次录制的结果。
+        """
+        route = get_route(method, url)
+        key = get_key(method, url, body)
+        with self.lock:
+            self.counts[route] += 1
+            entry = self.take(self.by_key[key])
+            if entry is None and key in self.last:
+                entry = self.last[key]
+            if entry is None:
+                entry = self.take(self.by_route[route])
+            if entry is None:
+                self.misses[route] += 1
+                return None
+            self.last[entry["key"]] = entry
+        if self.latency:
+            time.sleep(entry.get("elapsed", 0))
+        return entry
+
+    def stats(self):
+        return {"requests": dict(self.counts), "misses": dict(self.misses)}
+
+
+_cassettes = {}
+_lock = threading.Lock()
+
+
+def get_cassette(service):
+    """没有开启录制或回放时返回None"""
+    mode = get_mode()
+    if mode is None:
+        return None
+    with _lock:
+        if service not in _cassettes:
+            path = os.path.join(get_replay_dir(), f"{service}.jsonl")
+            _cassettes[service] = Cassette(service, mode, path)
+        return _cassettes[service]
+
+
+def get_stats():
+    return {service: cassette.stats() for service, cassette in _cassettes.items()}
+
+
+class ReplayAdapter(HTTPAdapter):
+    """给requests.Session使用的适配器"""
+
+    def __init__(self, cassette, **kwargs):
+        super().__init__(**kwargs)
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        if self.cassette.mode == RECORD:
+            response = super().send(request, **kwargs)
+            self.cassette.record(
+                request.method,
+                request.url,
+                request.body,
+                response.status_code,
+                response.headers,
+                response.content,
+                response.elapsed.total_seconds(),
+            )
+            return response
+        entry = self.cassette.play(request.method, request.url, request.body)
+        if entry is None:
+            raise requests.ConnectionError(
+                f"回放中没有找到请求 {request.method} {request.url}", request=request
+            )
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response._content = entry["body"].encode("utf-8")
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+
+class ReplayTransport(httpx.BaseTransport):
+    """给notion_client使用的httpx传输层"""
+
+    def __init__(self, cassette):
+        self.cassette = cassette
+        self.transport = httpx.HTTPTransport() if cassette.mode == RECORD else None
+
+    def handle_request(self, request):
+        body = request.read()
+        url = str(request.url)
+        if self.cassette.mode == RECORD:
+            started_at = time.monotonic()
+            response = self.transport.handle_request(request)
+            content = response.read()
+            response.close()
+            self.cassette.record(
+                request.method,
+                url,
+                body,
+                response.status_code,
+                response.headers,
+                content,
+                time.monotonic() - started_at,
+            )
+            headers = {
+                k: v for k, v in response.headers.items() if k.lower() in KEPT_HEADERS
+            }
+            return httpx.Response(
+                response.status_code, headers=headers, content=content, request=request
+            )
+        entry = self.cassette.play(request.method, url, body)
+        if entry is None:
+            raise httpx.ConnectError(
+                f"回放中没有找到请求 {request.method} {url}", request=request
+            )
+        return httpx.Response(
+            entry["status"],
+            headers=entry["headers"],
+            content=entry["body"].encode("utf-8"),
+            request=request,
+        )
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+def mount_session(session):
+    """开启录制或回放时替换requests.Session的适配器"""
+    cassette = get_cassette("weread")
+    if cassette is not None:
+        session.mount("https://", ReplayAdapter(cassette))
+
+
+def get_httpx_client():
+    """开启录制或回放时返回使用ReplayTransport的httpx.Client，否则返回None"""
+    cassette = get_cassette("notion")
+    if cassette is None:
+        return None
+    return httpx.Client(transport=ReplayTransport(cassette))
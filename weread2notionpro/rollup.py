@@ -0,0 +1,47 @@
+"""按周、月、年汇总每天的阅读时长，代替Notion中的汇总属性"""
+from datetime import timedelta
+
+from weread2notionpro.date_dimension import build_calendar
+
+# 写入周、月、年数据库的数字属性
+TOTAL_PROPERTY = "总阅读时长"
+ACTIVE_DAYS_PROPERTY = "阅读天数"
+STREAK_PROPERTY = "最长连续阅读天数"
+ROLLUP_PROPERTIES = (TOTAL_PROPERTY, ACTIVE_DAYS_PROPERTY, STREAK_PROPERTY)
+# 汇总的周期，对应CalendarDay中的字段前缀
+PERIODS = ("year", "month", "week")
+
+
+def compute_rollups(readTimes):
+    """readTimes为 {当天0点的时间戳: 阅读秒数}，返回 {period: {key: (汇总值, 周期中的一天)}}
+
+    汇总值为 {总阅读时长, 阅读天数, 最长连续阅读天数}，阅读时长为0的日期不算阅读天数。
+    """
+    calendar = build_calendar(readTimes.keys())
+    days = {}
+    for timestamp, duration in readTimes.items():
+        day = calendar.get(timestamp)
+        days[day.date] = (day, days.get(day.date, (day, 0))[1] + (duration or 0))
+    rollups = {period: {} for period in PERIODS}
+    streaks = {period: {} for period in PERIODS}
+    previous = None
+    for date in sorted(days):
+        day, duration = days.get(date)
+        for period in PERIODS:
+            key = getattr(day, f"{period}_key")
+            values, _ = rollups[period].setdefault(
+                key,
+                ({TOTAL_PROPERTY: 0, ACTIVE_DAYS_PROPERTY: 0, STREAK_PROPERTY: 0}, day),
+            )
+            values[TOTAL_PROPERTY] += duration
+            if duration <= 0:
+                streaks[period][key] = 0
+                continue
+            values[ACTIVE_DAYS_PROPERTY] += 1
+            # 连续阅读只在同一个周期内计算
+            streak = streaks[period].get(key, 0)
+            streak = streak + 1 if previous == date - timedelta(days=1) else 1
+            streaks[period][key] = streak
+            values[STREAK_PROPERTY] = max(values[STREAK_PROPERTY], streak)
+        previous = date if duration > 0 else None
+    return rollups
@@ -0,0 +1,73 @@
+"""在一个进程中同步书架、笔记和阅读时长
+
+三个任务共享同一个微信读书会话、NotionHelper和日期缓存。笔记同步只处理书架中已有的书，
+需要等书架同步完成；阅读时长和它们没有依赖，同时运行。
+"""
+import argparse
+import sys
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from weread2notionpro import book, read_time, weread
+from weread2notionpro.notion_helper import NotionHelper
+from weread2notionpro.weread_api import WeReadApi
+
+# 任务名: (依赖的任务, 模块)
+STAGES = {
+    "book": ((), book),
+    "weread": (("book",), weread),
+    "read_time": ((), read_time),
+}
+
+
+def run_stages(names):
+    """按依赖关系运行任务，没有依赖关系的任务同时运行，依赖的任务失败时跳过，返回失败的任务"""
+    pending = list(names)
+    running = {}
+    done = set()
+    failed = set()
+    with ThreadPoolExecutor(max_workers=len(names)) as executor:
+        while pending or running:
+            for name in list(pending):
+                dependencies = [x for x in STAGES[name][0] if x in names]
+                if any(x in failed for x in dependencies):
+                    print(f"{name}依赖的任务失败，跳过")
+                    pending.remove(name)
+                    failed.add(name)
+                elif all(x in done for x in dependencies):
+                    pending.remove(name)
+                    running[executor.submit(STAGES[name][1].main)] = name
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    done.add(name)
+                except Exception as e:
+                    print(f"{name}同步失败: {e}")
+                    # 任务之间互不影响，这里是CI日志中唯一能看到失败原因的地方
+                    traceback.print_exc()
+                    failed.add(name)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="同步书架、笔记和阅读时长")
+    parser.add_argument("stages", nargs="*", help=f"默认运行 {' '.join(STAGES)}")
+    options = parser.parse_args()
+    for name in options.stages:
+        if name not in STAGES:
+            parser.error(f"不支持的任务{name}，可选 {' '.join(STAGES)}")
+    names = [name for name in STAGES if not options.stages or name in options.stages]
+    weread_api = WeReadApi()
+    notion_helper = NotionHelper()
+    for _, module in STAGES.values():
+        module.init(weread_api, notion_helper)
+    failed = run_stages(names)
+    if failed:
+        print(f"同步失败的任务: {' '.join(name for name in names if name in failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+import json
+import os
+import sqlite3
+import threading
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 表结构变化时递增，只新增表时不需要重建
+SCHEMA_VERSION = 4
+# 低于这个版本的表结构不兼容，需要重建本地状态，重新从Notion获取
+COMPATIBLE_VERSION = 2
+DEFAULT_STATE_PATH = "sync_state.db"
+# 关联缓存最多保留的条数，超过时删除最久没有使用的
+RELATION_CACHE_SIZE = int(os.getenv("RELATION_CACHE_SIZE", 20000))
+
+# 兼容版本之间的升级语句，key为升级后的版本
+MIGRATIONS = {
+    4: [
+        "ALTER TABLE note ADD COLUMN content_hash TEXT",
+        "ALTER TABLE note ADD COLUMN block_type TEXT",
+    ],
+}
+
+BOOKMARK = "bookmark"
+REVIEW = "review"
+CHAPTER = "chapter"
+
+TABLES = [
+    """CREATE TABLE IF NOT EXISTS book (
+        book_id TEXT PRIMARY KEY,
+        page_id TEXT,
+        toc_block_id TEXT,
+        sort INTEGER
+    )""",
+    """CREATE TABLE IF NOT EXISTS note (
+        book_id TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        note_id TEXT NOT NULL,
+        block_id TEXT,
+        page_id TEXT,
+        chapter_uid INTEGER,
+        range TEXT,
+        content_hash TEXT,
+        block_type TEXT,
+        PRIMARY KEY (book_id, kind, note_id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS synckey (
+        book_id TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        synckey INTEGER,
+        PRIMARY KEY (book_id, kind)
+    )""",
+    """CREATE TABLE IF NOT EXISTS chapter (
+        book_id TEXT PRIMARY KEY,
+        data TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS relation (
+        database_id TEXT NOT NULL,
+        title TEXT NOT NULL,
+        page_id TEXT NOT NULL,
+        last_used INTEGER,
+        validated_at INTEGER,
+        PRIMARY KEY (database_id, title)
+    )""",
+    """CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )""",
+]
+
+
+class SyncState:
+    """本地同步状态，记录写入Notion的页面ID、块ID、目录块ID和Sort"""
+
+    def __init__(self, path=None):
+        self.path = path or os.getenv("SYNC_STATE_PATH") or DEFAULT_STATE_PATH
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.migrate()
+
+    def migrate(self):
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version == SCHEMA_VERSION:
+            return
+        with self.lock, self.conn:
+            if 0 < version < COMPATIBLE_VERSION:
+                print(f"本地同步状态版本{version}与当前版本{SCHEMA_VERSION}不兼容，重新创建")
+                tables = self.conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type='table'"
+                ).fetchall()
+                for (name,) in tables:
+                    self.conn.execute(f"DROP TABLE IF EXISTS {name}")
+            elif version > 0:
+                for target in range(version + 1, SCHEMA_VERSION + 1):
+                    for statement in MIGRATIONS.get(target, []):
+                        self.conn.execute(statement)
+            for table in TABLES:
+                self.conn.execute(table)
+            self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def get_book(self, book_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT page_id, toc_block_id, sort FROM book WHERE book_id = ?",
+                (book_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return {"pageId": row[0], "tocBlockId": row[1], "Sort": row[2]}
+
+    def is_fresh(self, book_id, sort):
+        """本地记录的Sort和Notion中的一致时，说明本地状态可信"""
+        book = self.get_book(book_id)
+        return book is not None and sort is not None and book.get("Sort") == sort
+
+    def set_book(self, book_id, page_id, sort):
+        with self.lock, self.conn:
+            self.conn.execute(
+                """INSERT INTO book (book_id, page_id, sort) VALUES (?, ?, ?)
+                ON CONFLICT(book_id) DO UPDATE SET page_id = excluded.page_id,
+                sort = excluded.sort""",
+                (book_id, page_id, sort),
+            )
+
+    def set_toc_block(self, book_id, page_id, block_id):
+        with self.lock, self.conn:
+            self.conn.execute(
+                """INSERT INTO book (book_id, page_id, toc_block_id) VALUES (?, ?, ?)
+                ON CONFLICT(book_id) DO UPDATE SET page_id = excluded.page_id,
+                toc_block_id = excluded.toc_block_id""",
+                (book_id, page_id, block_id),
+            )
+
+    def delete_block_parents(self, condition, params):
+        """删除note中符合条件的块在meta中记录的父块，需要在删除note之前调用"""
+        self.conn.execute(
+            f"DELETE FROM meta WHERE key IN (SELECT 'block_parent:' || block_id FROM note WHERE {condition})",
+            params,
+        )
+
+    def clear_book(self, book_id):
+        """本地状态过期，删除这本书的所有记录"""
+        with self.lock, self.conn:
+            self.delete_block_parents("book_id = ?", (book_id,))
+            for table in ("note", "synckey", "chapter", "book"):
+                self.conn.execute(f"DELETE FROM {table} WHERE book_id = ?", (book_id,))
+
+    def get_notes(self, book_id, kind):
+        """返回 {note_id: (block_id, page_id, chapter_uid, range, content_hash, block_type)}"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT note_id, block_id, page_id, chapter_uid, range, content_hash, block_type FROM note WHERE book_id = ? AND kind = ?",
+                (book_id, kind),
+            ).fetchall()
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+    def save_notes(self, book_id, kind, notes):
+        """用从Notion获取的结果替换本地记录，notes格式同get_notes"""
+        block_ids = [note[0] for note in notes.values()]
+        with self.lock, self.conn:
+            # 页面中已经不存在的块不再需要记录父块
+            self.delete_block_parents(
+                f"book_id = ? AND kind = ? AND block_id NOT IN ({','.join('?' * len(block_ids))})",
+                (book_id, kind, *block_ids),
+            )
+            self.conn.execute(
+                "DELETE FROM note WHERE book_id = ? AND kind = ?", (book_id, kind)
+            )
+            self.conn.executemany(
+                "INSERT INTO note (book_id, kind, note_id, block_id, page_id, chapter_uid, range, content_hash, block_type) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (book_id, kind, str(note_id), *note)
+                    for note_id, note in notes.items()
+                ],
+            )
+
+    def put_note(
+        self,
+        book_id,
+        kind,
+        note_id,
+        block_id,
+        page_id,
+        chapter_uid=None,
+        range=None,
+        content_hash=None,
+        block_type=None,
+    ):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO note (book_id, kind, note_id, block_id, page_id, chapter_uid, range, content_hash, block_type) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    book_id,
+                    kind,
+                    str(note_id),
+                    block_id,
+                    page_id,
+                    chapter_uid,
+                    range,
+                    content_hash,
+                    block_type,
+                ),
+            )
+
+    def set_note_hash(self, book_id, kind, note_id, content_hash, block_type):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE note SET content_hash = ?, block_type = ? WHERE book_id = ? AND kind = ? AND note_id = ?",
+                (content_hash, block_type, book_id, kind, str(note_id)),
+            )
+
+    def delete_note(self, book_id, kind, note_id):
+        with self.lock, self.conn:
+            self.delete_block_parents(
+                "book_id = ? AND kind = ? AND note_id = ?", (book_id, kind, str(note_id))
+            )
+            self.conn.execute(
+                "DELETE FROM note WHERE book_id = ? AND kind = ? AND note_id = ?",
+                (book_id, kind, str(note_id)),
+            )
+
+    def get_synckey(self, book_id, kind):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT synckey FROM synckey WHERE book_id = ? AND kind = ?",
+                (book_id, kind),
+            ).fetchone()
+        return row[0] if row and row[0] else 0
+
+    def set_synckeys(self, book_id, synckeys):
+        """synckeys为 {kind: synckey}，整本书同步完成后再保存"""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO synckey (book_id, kind, synckey) VALUES (?, ?, ?)",
+                [(book_id, kind, synckey) for kind, synckey in synckeys.items()],
+            )
+
+    def get_chapters(self, book_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT data FROM chapter WHERE book_id = ?", (book_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {int(key): value for key, value in json.loads(row[0]).items()}
+
+    def set_chapters(self, book_id, chapters):
+        # blockId是同步过程中写入的，单独记录在note表中
+        chapters = {
+            key: {k: v for k, v in value.items() if k != "blockId"}
+            for key, value in chapters.items()
+        }
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO chapter (book_id, data) VALUES (?, ?)",
+                (book_id, json.dumps(chapters, ensure_ascii=False)),
+            )
+
+    def get_relation(self, database_id, title):
+        """返回 (page_id, validated_at)"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT page_id, validated_at FROM relation WHERE database_id = ? AND title = ?",
+                (database_id, title),
+            ).fetchone()
+
+    def put_relations(self, database_id, relations, validated_at):
+        """relations为 {title: page_id}"""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO relation (database_id, title, page_id, last_used, validated_at) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (database_id, title, page_id, validated_at, validated_at)
+                    for title, page_id in relations.items()
+                ],
+            )
+
+    def touch_relation(self, database_id, title, used_at, validated_at=None):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE relation SET last_used = ?, validated_at = COALESCE(?, validated_at) WHERE database_id = ? AND title = ?",
+                (used_at, validated_at, database_id, title),
+            )
+
+    def delete_relation(self, database_id, title):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM relation WHERE database_id = ? AND title = ?",
+                (database_id, title),
+            )
+
+    def evict_relations(self, max_size=RELATION_CACHE_SIZE):
+        """超过max_size时删除最久没有使用的关联"""
+        with self.lock, self.conn:
+            self.conn.execute(
+                """DELETE FROM relation WHERE rowid IN (
+                    SELECT rowid FROM relation ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )""",
+                (max_size,),
+            )
+
+    def get_value(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_value(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (key, json.dumps(value, ensure_ascii=False)),
+            )
+
+    def delete_value(self, key):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM meta WHERE key = ?", (key,))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,65 @@
+import json
+import os
+import threading
+from collections import Counter
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+OFF = 0
+# 只打印返回内容的大小
+INFO = 1
+# 打印截断后的返回内容
+PREVIEW = 2
+# 打印完整的返回内容，并保存到文件
+DEBUG = 3
+LEVELS = {"off": OFF, "info": INFO, "preview": PREVIEW, "debug": DEBUG}
+
+
+def parse_sample(value):
+    """解析 "get_bookinfo=10,get_read_info=5"，表示每N次请求记录一次"""
+    sample = {}
+    for item in value.split(","):
+        if "=" in item:
+            endpoint, every = item.split("=", 1)
+            sample[endpoint.strip()] = max(1, int(every))
+    return sample
+
+
+TRACE_LEVEL = LEVELS.get(os.getenv("WEREAD_TRACE_LEVEL", "info").strip().lower(), INFO)
+# 预览最多打印的字符数
+TRACE_PREVIEW_SIZE = int(os.getenv("WEREAD_TRACE_PREVIEW_SIZE", 500))
+TRACE_SAMPLE = parse_sample(os.getenv("WEREAD_TRACE_SAMPLE", ""))
+
+_counts = Counter()
+_lock = threading.Lock()
+
+
+def should_trace(endpoint):
+    if TRACE_LEVEL == OFF:
+        return False
+    if TRACE_LEVEL == DEBUG:
+        return True
+    with _lock:
+        count = _counts[endpoint]
+        _counts[endpoint] += 1
+    return count % TRACE_SAMPLE.get(endpoint, 1) == 0
+
+
+def trace_response(endpoint, response, data, dump_file=None):
+    """按日志级别记录接口返回的内容，data是已经解析过的返回结果"""
+    if not should_trace(endpoint):
+        return
+    if TRACE_LEVEL == DEBUG:
+        content = json.dumps(data, indent=4, ensure_ascii=False)
+        print(f"请求 {endpoint} 内容: {content}")
+        if dump_file:
+            with open(dump_file, "w") as f:
+                f.write(content)
+    elif TRACE_LEVEL == PREVIEW:
+        text = response.text
+        suffix = "..." if len(text) > TRACE_PREVIEW_SIZE else ""
+        print(f"请求 {endpoint} 内容: {text[:TRACE_PREVIEW_SIZE]}{suffix}")
+    else:
+        print(f"请求 {endpoint} 返回{len(response.content)}字节")
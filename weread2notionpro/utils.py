@@ -114,7 +114,7 @@ def get_quote(content):
     }
 
 
-def get_block(content,type,show_color, style, colorStyle, reviewId):
+def get_block(content,type,show_color, style, colorStyle, reviewId, abstract=None):
     color = "default"
     if show_color:
         # 根据划线颜色设置文字的颜色
@@ -153,6 +153,9 @@ def get_block(content,type,show_color, style, colorStyle, reviewId):
         if reviewId != None:
             emoji = "✍️"
         block[type]["icon"] = {"emoji": emoji}
+    if abstract:
+        # 笔记对应的原文作为子块和笔记一起插入
+        block[type]["children"] = [get_quote(abstract)]
     return block
 
 
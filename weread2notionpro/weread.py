@@ -1,69 +1,179 @@
-from weread2notionpro.notion_helper import NotionHelper
-from weread2notionpro.weread_api import WeReadApi
+import os
+import time
+from dataclasses import replace
+
+from weread2notionpro.block_diff import diff_blocks, get_block_hash, get_note_key
+from weread2notionpro.concurrency import ordered_map, prefetch
+from weread2notionpro.models import Bookmark, Chapter, Review
+from weread2notionpro.notion_helper import NOTION_CONCURRENCY, NotionHelper
+from weread2notionpro.sync_state import BOOKMARK, CHAPTER, REVIEW
+from weread2notionpro.weread_api import REVIEW_CHAPTER, WeReadApi
 
 from weread2notionpro.utils import (
     get_block,
     get_heading,
     get_number,
     get_number_from_result,
-    get_quote,
+    get_property_value,
+    get_rich_text,
     get_rich_text_from_result,
     get_table_of_contents,
+    get_title,
 )
 
+# 设置为false时每次都全量获取划线、笔记和章节
+INCREMENTAL = os.getenv("WEREAD_INCREMENTAL", "true").lower() != "false"
+# 增量同步可能漏掉删除或者synckey出错，每本书每隔多少天从头获取并和Notion完整比较一次
+WEREAD_FULL_SYNC_DAYS = int(os.getenv("WEREAD_FULL_SYNC_DAYS", 7))
+# 最多提前获取几本书，限制内存占用
+PIPELINE_DEPTH = int(os.getenv("PIPELINE_DEPTH", 2))
+NOTE_MODELS = {BOOKMARK: Bookmark, REVIEW: Review}
 
-def get_bookmark_list(page_id, bookId):
-    """获取我的划线"""
-    filter = {
-        "and": [
-            {"property": "书籍", "relation": {"contains": page_id}},
-            {"property": "blockId", "rich_text": {"is_not_empty": True}},
-        ]
-    }
-    results = notion_helper.query_all_by_book(
-        notion_helper.bookmark_database_id, filter
+
+def get_synced_notes(page_id, bookId, kind, fresh):
+    """获取已经同步过的笔记，返回 {id: (blockId, pageId, chapterUid, range, hash, type)}，本地状态可信时不查询Notion"""
+    if fresh:
+        return sync_state.get_notes(bookId, kind)
+    if kind == CHAPTER:
+        filter = {"property": "书籍", "relation": {"contains": page_id}}
+        results = notion_helper.query_all_by_book(
+            notion_helper.chapter_database_id, filter
+        )
+        notes = {
+            str(int(get_number_from_result(x, "chapterUid"))): (
+                get_rich_text_from_result(x, "blockId"),
+                x.get("id"),
+                int(get_number_from_result(x, "chapterUid")),
+                None,
+                None,
+                None,
+            )
+            for x in results
+        }
+    else:
+        database_id = (
+            notion_helper.bookmark_database_id
+            if kind == BOOKMARK
+            else notion_helper.review_database_id
+        )
+        filter = {
+            "and": [
+                {"property": "书籍", "relation": {"contains": page_id}},
+                {"property": "blockId", "rich_text": {"is_not_empty": True}},
+            ]
+        }
+        results = notion_helper.query_all_by_book(database_id, filter)
+        notes = {
+            get_rich_text_from_result(x, f"{kind}Id"): (
+                get_rich_text_from_result(x, "blockId"),
+                x.get("id"),
+                get_number_from_result(x, "chapterUid"),
+                get_property_value(x.get("properties").get("range"))
+                if x.get("properties").get("range")
+                else None,
+                None,
+                None,
+            )
+            for x in results
+        }
+    sync_state.save_notes(bookId, kind, notes)
+    return notes
+
+
+def get_current_notes(page_id, bookId, fresh):
+    """获取页面中已经同步的划线、笔记和章节，key为 (kind, id)"""
+    current = {}
+    for kind in (BOOKMARK, REVIEW, CHAPTER):
+        notes = get_synced_notes(page_id, bookId, kind, fresh)
+        current.update({(kind, note_id): note for note_id, note in notes.items()})
+    return current
+
+
+def delete_notes(bookId, notes):
+    """删除微信读书中已经不存在的笔记"""
+    for (kind, note_id), note in notes.items():
+        notion_helper.delete_block(note[0])
+        notion_helper.delete_block(note[1])
+        sync_state.delete_note(bookId, kind, note_id)
+
+
+def is_full_sync_due(bookId):
+    full_sync_at = sync_state.get_value(f"full_sync:{bookId}", 0)
+    return time.time() - full_sync_at >= WEREAD_FULL_SYNC_DAYS * 86400
+
+
+def get_synckey(bookId, kind, fresh):
+    """本地状态可信时才使用增量获取"""
+    if INCREMENTAL and fresh:
+        return sync_state.get_synckey(bookId, kind)
+    return 0
+
+
+def to_anchor(kind, note_id, note):
+    """没有变化的笔记，只保留排序需要的字段，作为插入新笔记的位置"""
+    return NOTE_MODELS[kind](
+        note_id,
+        chapter_uid=int(note[2]) if note[2] is not None else None,
+        range=note[3] or None,
+        block_id=note[0],
+        anchor=True,
     )
-    dict1 = {
-        get_rich_text_from_result(x, "bookmarkId"): get_rich_text_from_result(
-            x, "blockId"
+
+
+def merge_notes(kind, current, updated, removed, incremental):
+    """增量获取时，没有变化也没有被删除的笔记作为锚点加入列表"""
+    if incremental:
+        skip = set(removed) | set(x.note_id for x in updated)
+        updated.extend(
+            to_anchor(kind, note_id, note)
+            for (note_kind, note_id), note in current.items()
+            if note_kind == kind and note_id not in skip
         )
-        for x in results
-    }
-    dict2 = {get_rich_text_from_result(x, "blockId"): x.get("id") for x in results}
-    bookmarks = weread_api.get_bookmark_list(bookId)
-    for i in bookmarks:
-        if i.get("bookmarkId") in dict1:
-            i["blockId"] = dict1.pop(i.get("bookmarkId"))
-    for blockId in dict1.values():
-        notion_helper.delete_block(blockId)
-        notion_helper.delete_block(dict2.get(blockId))
-    return bookmarks
-
-
-def get_review_list(page_id,bookId):
+    return updated
+
+
+def get_bookmark_list(bookId, fresh, synckeys, current):
+    """获取我的划线"""
+    synckey = get_synckey(bookId, BOOKMARK, fresh)
+    bookmarks, removed, synckeys[BOOKMARK] = weread_api.get_bookmark_changes(
+        bookId, synckey
+    )
+    return merge_notes(BOOKMARK, current, bookmarks, removed, synckey != 0)
+
+
+def get_review_list(bookId, fresh, synckeys, current):
     """获取笔记"""
-    filter = {
-        "and": [
-            {"property": "书籍", "relation": {"contains": page_id}},
-            {"property": "blockId", "rich_text": {"is_not_empty": True}},
-        ]
-    }
-    results = notion_helper.query_all_by_book(notion_helper.review_database_id, filter)
-    dict1 = {
-        get_rich_text_from_result(x, "reviewId"): get_rich_text_from_result(
-            x, "blockId"
-        )
-        for x in results
-    }
-    dict2 = {get_rich_text_from_result(x, "blockId"): x.get("id") for x in results}
-    reviews = weread_api.get_review_list(bookId)
-    for i in reviews:
-        if i.get("reviewId") in dict1:
-            i["blockId"] = dict1.pop(i.get("reviewId"))
-    for blockId in dict1.values():
-        notion_helper.delete_block(blockId)
-        notion_helper.delete_block(dict2.get(blockId))
-    return reviews
+    synckey = get_synckey(bookId, REVIEW, fresh)
+    reviews, removed, synckeys[REVIEW] = weread_api.get_review_changes(
+        bookId, synckey
+    )
+    return merge_notes(REVIEW, current, reviews, removed, synckey != 0)
+
+
+def get_chapter_synckey(bookId, fresh):
+    """本地有章节缓存时才增量获取章节"""
+    if fresh and sync_state.get_chapters(bookId) is not None:
+        return get_synckey(bookId, CHAPTER, fresh)
+    return 0
+
+
+def get_chapter_info(bookId, fresh, synckeys):
+    """获取章节，本地有缓存时只获取变化的章节"""
+    synckey = get_chapter_synckey(bookId, fresh)
+    chapters = {}
+    if synckey != 0:
+        chapters = {
+            key: Chapter.from_dict(value)
+            for key, value in sync_state.get_chapters(bookId).items()
+        }
+    updated, removed, synckeys[CHAPTER] = weread_api.get_chapter_changes(
+        bookId, synckey
+    )
+    chapters.update({item.chapter_uid: item for item in updated})
+    for chapterUid in removed:
+        chapters.pop(chapterUid, None)
+    chapters[REVIEW_CHAPTER.chapter_uid] = replace(REVIEW_CHAPTER)
+    return chapters
 
 
 def check(bookId):
@@ -98,167 +208,282 @@ def get_sort():
 
 
 
-def sort_notes(page_id, chapter, bookmark_list):
+def sort_notes(chapter, bookmark_list):
     """对笔记进行排序"""
     bookmark_list = sorted(
         bookmark_list,
         key=lambda x: (
-            x.get("chapterUid", 1),
+            x.chapter_uid if x.chapter_uid is not None else 1,
             0
-            if (x.get("range", "") == "" or x.get("range").split("-")[0] == "")
-            else int(x.get("range").split("-")[0]),
+            if (not x.range or x.range.split("-")[0] == "")
+            else int(x.range.split("-")[0]),
         ),
     )
 
     notes = []
     if chapter != None:
-        filter = {"property": "书籍", "relation": {"contains": page_id}}
-        results = notion_helper.query_all_by_book(
-            notion_helper.chapter_database_id, filter
-        )
-        dict1 = {
-            get_number_from_result(x, "chapterUid"): get_rich_text_from_result(
-                x, "blockId"
-            )
-            for x in results
-        }
-        dict2 = {get_rich_text_from_result(x, "blockId"): x.get("id") for x in results}
         d = {}
         for data in bookmark_list:
-            chapterUid = data.get("chapterUid", 1)
+            chapterUid = data.chapter_uid if data.chapter_uid is not None else 1
             if chapterUid not in d:
                 d[chapterUid] = []
             d[chapterUid].append(data)
         for key, value in d.items():
             if key in chapter:
-                if key in dict1:
-                    chapter.get(key)["blockId"] = dict1.pop(key)
                 notes.append(chapter.get(key))
             notes.extend(value)
-        for blockId in dict1.values():
-            notion_helper.delete_block(blockId)
-            notion_helper.delete_block(dict2.get(blockId))
     else:
         notes.extend(bookmark_list)
     return notes
 
 
-def append_blocks(id, contents):
-    print(f"笔记数{len(contents)}")
-    before_block_id = ""
+def get_toc_block_id(id, bookId):
+    """获取目录块ID，本地有记录时不请求Notion"""
+    book = sync_state.get_book(bookId)
+    if book and book.get("tocBlockId"):
+        return book.get("tocBlockId")
     block_children = notion_helper.get_block_children(id)
     if len(block_children) > 0 and block_children[0].get("type") == "table_of_contents":
-        before_block_id = block_children[0].get("id")
+        block_id = block_children[0].get("id")
     else:
         response = notion_helper.append_blocks(
             block_id=id, children=[get_table_of_contents()]
         )
-        before_block_id = response.get("results")[0].get("id")
-    blocks = []
-    sub_contents = []
+        block_id = response.get("results")[0].get("id")
+    sync_state.set_toc_block(bookId, id, block_id)
+    return block_id
+
+
+def should_insert(content):
+    """不同步书签时跳过新的书签"""
+    return notion_helper.sync_bookmark or getattr(content, "type", None) != 0
+
+
+def update_blocks(bookId, current, updates, hashes):
+    """原地更新内容变化的块和对应的数据库记录，块和子块都写入后才保存新的摘要"""
+    for content, block in updates:
+        key = get_note_key(content)
+        print(f"正在更新{key[0]} {key[1]}")
+        notion_helper.update_block(content.block_id, block)
+        notion_helper.update_book_page(
+            page_id=current.get(key)[1], properties=get_row_properties(content)
+        )
+        block_hash, block_type = hashes.pop(key)
+        sync_state.set_note_hash(bookId, key[0], key[1], block_hash, block_type)
+
+
+def get_row_properties(content):
+    """笔记内容修改后需要同步更新的数据库字段"""
+    if isinstance(content, Bookmark):
+        return {"Name": get_title(content.mark_text)}
+    elif isinstance(content, Review):
+        properties = {"Name": get_title(content.content)}
+        if content.abstract is not None:
+            properties["abstract"] = get_rich_text(content.abstract)
+        return properties
+    return {"Name": get_title(content.title)}
+
+
+def append_blocks(id, bookId, inserts, fresh):
+    print(f"笔记数{sum(len(contents) for _, contents in inserts)}")
+    toc_block_id = get_toc_block_id(id, bookId)
+    if fresh:
+        # 本地状态中的块都是插入到页面中的顶层块，不需要再查询父块
+        notion_helper.mark_top_level_blocks(
+            [after for after, _ in inserts if after is not None] + [toc_block_id]
+        )
     l = []
-    for content in contents:
-        if len(blocks) == 100:
-            results = append_blocks_to_notion(id, blocks, before_block_id, sub_contents)
-            before_block_id = results[-1].get("blockId")
+    for after, contents in inserts:
+        after = after or toc_block_id
+        for i in range(0, len(contents), 100):
+            results = append_blocks_to_notion(id, after, contents[i : i + 100])
+            after = results[-1][0].block_id
             l.extend(results)
-            blocks.clear()
-            sub_contents.clear()
-            if not notion_helper.sync_bookmark and content.get("type")==0:
-                continue
-            blocks.append(content_to_block(content))
-            sub_contents.append(content)
-        elif "blockId" in content:
-            if len(blocks) > 0:
-                l.extend(
-                    append_blocks_to_notion(id, blocks, before_block_id, sub_contents)
-                )
-                blocks.clear()
-                sub_contents.clear()
-            before_block_id = content["blockId"]
-        else:
-            if not notion_helper.sync_bookmark and content.get("type")==0:
-                continue
-            blocks.append(content_to_block(content))
-            sub_contents.append(content)
-    
-    if len(blocks) > 0:
-        l.extend(append_blocks_to_notion(id, blocks, before_block_id, sub_contents))
-    for index, value in enumerate(l):
-        print(f"正在插入第{index+1}条笔记，共{len(l)}条")
-        if "bookmarkId" in value:
-            notion_helper.insert_bookmark(id, value)
-        elif "reviewId" in value:
-            notion_helper.insert_review(id, value)
+    notion_helper.ensure_date_relations(
+        [
+            int(x.create_time)
+            for x, _ in l
+            if getattr(x, "create_time", None) is not None
+        ]
+    )
+    failures = []
+    rows = ordered_map(lambda item: insert_row(id, item[0]), l, NOTION_CONCURRENCY)
+    for index, ((value, block), (page, error)) in enumerate(rows):
+        kind, note_id = get_note_key(value)
+        if error is not None:
+            print(f"插入第{index+1}条笔记失败: {error}")
+            failures.append(value)
+            continue
+        print(f"成功插入第{index+1}条笔记，共{len(l)}条")
+        sync_state.put_note(
+            bookId,
+            kind,
+            note_id,
+            value.block_id,
+            page.get("id"),
+            value.chapter_uid,
+            getattr(value, "range", None),
+            get_block_hash(block),
+            block.get("type"),
+        )
+    for value in failures:
+        # 删除没有记录的块，下次同步时重新插入
+        notion_helper.delete_block(value.block_id)
+    return failures
+
+
+def insert_row(id, value):
+    """插入一条划线、笔记或章节记录，返回 (page, error)，失败不影响其他记录"""
+    try:
+        if isinstance(value, Bookmark):
+            return notion_helper.insert_bookmark(id, value), None
+        elif isinstance(value, Review):
+            return notion_helper.insert_review(id, value), None
         else:
-            notion_helper.insert_chapter(id, value)
+            return notion_helper.insert_chapter(id, value), None
+    except Exception as e:
+        return None, e
 
 
 def content_to_block(content):
-    if "bookmarkId" in content:
+    if isinstance(content, Bookmark):
         return get_block(
-            content.get("markText",""),
+            content.mark_text,
             notion_helper.block_type,
             notion_helper.show_color,
-            content.get("style"),
-            content.get("colorStyle"),
-            content.get("reviewId"),
+            content.style,
+            content.color_style,
+            content.review_id,
         )
-    elif "reviewId" in content:
+    elif isinstance(content, Review):
         return get_block(
-            content.get("content",""),
+            content.content,
             notion_helper.block_type,
             notion_helper.show_color,
-            content.get("style"),
-            content.get("colorStyle"),
-            content.get("reviewId"),
+            None,
+            None,
+            content.review_id,
+            content.abstract,
         )
     else:
-        return get_heading(content.get("level"), content.get("title"))
+        return get_heading(content.level, content.title)
 
 
-def append_blocks_to_notion(id, blocks, after, contents):
+def append_blocks_to_notion(id, after, contents):
+    """插入一批块，返回 [(content, block)]"""
+    blocks = [content_to_block(content) for content in contents]
     response = notion_helper.append_blocks_after(
         block_id=id, children=blocks, after=after
     )
     results = response.get("results")
     l = []
     for index, content in enumerate(contents):
-        result = results[index]
-        if content.get("abstract") != None and content.get("abstract") != "":
-            notion_helper.append_blocks(
-                block_id=result.get("id"), children=[get_quote(content.get("abstract"))]
-            )
-        content["blockId"] = result.get("id")
-        l.append(content)
+        # 原文已经作为子块插入，返回结果中只有顶层的块，和contents一一对应
+        content.block_id = results[index].get("id")
+        l.append((content, blocks[index]))
     return l
 
-weread_api = WeReadApi()
-notion_helper = NotionHelper()
+weread_api = None
+notion_helper = None
+sync_state = None
+
+
+def init(api=None, helper=None):
+    """创建WeReadApi和NotionHelper，统一入口会传入共享的实例"""
+    global weread_api, notion_helper, sync_state
+    weread_api = api or weread_api or WeReadApi()
+    notion_helper = helper or notion_helper or NotionHelper()
+    sync_state = notion_helper.sync_state
+
+
+def prepare_book(book):
+    """获取阶段：从微信读书获取章节和笔记，并和页面中已经同步的块比较"""
+    bookId = book.get("bookId")
+    pageId = book.get("pageId")
+    fresh = book.get("fresh")
+    synckeys = {}
+    current = get_current_notes(pageId, bookId, fresh)
+    chapter = get_chapter_info(bookId, fresh, synckeys)
+    bookmark_list = get_bookmark_list(bookId, fresh, synckeys, current)
+    reviews = get_review_list(bookId, fresh, synckeys, current)
+    bookmark_list.extend(reviews)
+    content = sort_notes(chapter, bookmark_list)
+    return {
+        "chapter": chapter,
+        "current": current,
+        "diff": diff_blocks(content, current, content_to_block, should_insert),
+        "synckeys": synckeys,
+    }
+
+
+def write_book(book, prepared):
+    """写入阶段：删除不存在的笔记，更新修改过的笔记，插入新的笔记，更新Sort"""
+    bookId = book.get("bookId")
+    pageId = book.get("pageId")
+    diff = prepared.get("diff")
+    delete_notes(bookId, diff.deletes)
+    update_blocks(bookId, prepared.get("current"), diff.updates, diff.hashes)
+    # 剩下的是内容没有变化、之前没有记录摘要的笔记
+    for (kind, note_id), (block_hash, block_type) in diff.hashes.items():
+        sync_state.set_note_hash(bookId, kind, note_id, block_hash, block_type)
+    failures = append_blocks(pageId, bookId, diff.inserts, book.get("fresh"))
+    if failures:
+        # 不更新Sort，下次运行时重新同步这本书
+        print(f"《{book.get('title')}》有{len(failures)}条笔记插入失败，下次运行时重试")
+        return
+    properties = {
+        "Sort":get_number(book.get("sort"))
+    }
+    notion_helper.update_book_page(page_id=pageId,properties=properties)
+    sync_state.set_book(bookId, pageId, book.get("sort"))
+    if not book.get("fresh"):
+        sync_state.set_value(f"full_sync:{bookId}", int(time.time()))
+    sync_state.set_synckeys(bookId, prepared.get("synckeys"))
+    sync_state.set_chapters(
+        bookId, {key: value.to_dict() for key, value in prepared.get("chapter").items()}
+    )
+
+
 def main():
+    init()
     notion_books = notion_helper.get_all_book()
     books = weread_api.get_notebooklist()
     if books != None:
+        need_sync = []
         for index, book in enumerate(books):
             bookId = book.get("bookId")
-            title = book.get("book").get("title")
-            sort = book.get("sort")
             if bookId not in notion_books:
                 continue
-            if sort == notion_books.get(bookId).get("Sort"):
+            if book.get("sort") == notion_books.get(bookId).get("Sort"):
                 continue
-            pageId = notion_books.get(bookId).get("pageId")
-            print(f"正在同步《{title}》,一共{len(books)}本，当前是第{index+1}本。")
-            chapter = weread_api.get_chapter_info(bookId)
-            bookmark_list = get_bookmark_list(pageId, bookId)
-            reviews = get_review_list(pageId,bookId)
-            bookmark_list.extend(reviews)
-            content = sort_notes(pageId, chapter, bookmark_list)
-            append_blocks(pageId, content)
-            properties = {
-                "Sort":get_number(sort)
+            fresh = sync_state.is_fresh(bookId, notion_books.get(bookId).get("Sort"))
+            if fresh and is_full_sync_due(bookId):
+                print(f"《{book.get('book').get('title')}》超过{WEREAD_FULL_SYNC_DAYS}天没有完整同步，重新完整同步")
+                fresh = False
+            if not fresh:
+                sync_state.clear_book(bookId)
+            need_sync.append(
+                {
+                    "bookId": bookId,
+                    "title": book.get("book").get("title"),
+                    "sort": book.get("sort"),
+                    "index": index,
+                    "pageId": notion_books.get(bookId).get("pageId"),
+                    "fresh": fresh,
+                }
+            )
+        weread_api.prefetch_chapters(
+            {
+                book.get("bookId"): get_chapter_synckey(book.get("bookId"), book.get("fresh"))
+                for book in need_sync
             }
-            notion_helper.update_book_page(page_id=pageId,properties=properties)
+        )
+        # 写入当前这本书时，后台线程已经在获取下一本书
+        for book, prepared in prefetch(prepare_book, need_sync, PIPELINE_DEPTH):
+            print(
+                f"正在同步《{book.get('title')}》,一共{len(books)}本，当前是第{book.get('index')+1}本。"
+            )
+            write_book(book, prepared)
 
 if __name__ == "__main__":
     main()
@@ -1,15 +1,25 @@
+import atexit
 import hashlib
-import json
 import os
 import re
+import threading
+import time
+from dataclasses import replace
 
 import requests
 from requests.utils import cookiejar_from_dict
-from retrying import retry
 from urllib.parse import quote
 from dotenv import load_dotenv
 
+from weread2notionpro.concurrency import RateLimiter, ordered_map
+from weread2notionpro.metrics import counted_retry, get_route, metrics
+from weread2notionpro.models import BookProgress, Bookmark, Chapter, Review
+from weread2notionpro.replay import REPLAY, get_mode, mount_session
+from weread2notionpro.trace import trace_response
+
 load_dotenv()
+# 和retrying.retry用法一样，重试次数计入请求统计
+retry = counted_retry("weread")
 WEREAD_URL = "https://weread.qq.com/"
 WEREAD_NOTEBOOKS_URL = "https://weread.qq.com/api/user/notebook"
 WEREAD_BOOKMARKLIST_URL = "https://weread.qq.com/web/book/bookmarklist"
@@ -19,6 +29,68 @@ WEREAD_REVIEW_LIST_URL = "https://weread.qq.com/web/review/list"
 WEREAD_BOOK_INFO = "https://weread.qq.com/web/book/info"
 WEREAD_READDATA_DETAIL = "https://weread.qq.com/web/readdata/detail"
 WEREAD_HISTORY_URL = "https://weread.qq.com/web/readdata/summary?synckey=0"
+# 会话有效期（秒），超过后重新访问首页
+SESSION_TTL = int(os.getenv("WEREAD_SESSION_TTL", 1800))
+# Cookie或会话失效时返回的错误码
+AUTH_ERRCODES = (-2012, -2010)
+# 同时请求微信读书的线程数
+WEREAD_CONCURRENCY = int(os.getenv("WEREAD_CONCURRENCY", 4))
+# 每秒最多请求微信读书的次数
+WEREAD_RATE_LIMIT = float(os.getenv("WEREAD_RATE_LIMIT", 5))
+# 每次请求章节信息的书籍数量
+CHAPTER_BATCH_SIZE = 50
+# 点评没有章节，统一放到这个虚拟章节下
+REVIEW_CHAPTER = Chapter(
+    chapter_uid=1000000,
+    chapter_idx=1000000,
+    update_time=1683825006,
+    read_ahead=0,
+    title="点评",
+    level=1,
+)
+# 点评类型的笔记
+REVIEW_TYPE = 4
+
+
+def get_removed_ids(removed, key):
+    """增量接口返回的删除列表可能是ID也可能是对象，统一转成ID"""
+    if not removed:
+        return []
+    return [x.get(key) if isinstance(x, dict) else x for x in removed]
+
+
+def get_json(r):
+    """每个返回结果只解析一次，解析失败时返回空字典"""
+    if not hasattr(r, "json_data"):
+        try:
+            r.json_data = r.json()
+        except ValueError:
+            r.json_data = {}
+    return r.json_data
+
+
+def parse_bookmarks(items):
+    return [Bookmark.from_dict(x) for x in items]
+
+
+def parse_reviews(items):
+    """点评没有章节，放到REVIEW_CHAPTER下"""
+    reviews = []
+    for x in items:
+        review = Review.from_dict(x.get("review"))
+        if review.type == REVIEW_TYPE and review.chapter_uid is None:
+            review.chapter_uid = REVIEW_CHAPTER.chapter_uid
+        reviews.append(review)
+    return reviews
+
+
+def parse_chapters(items):
+    return [Chapter.from_dict(x) for x in items]
+
+
+def parse_book_progress(items):
+    """返回 {bookId: BookProgress}"""
+    return {x.get("bookId"): BookProgress.from_dict(x) for x in items}
 
 
 class WeReadApi:
@@ -28,6 +100,63 @@ class WeReadApi:
         print("成功获取cookie")
         self.session = requests.Session()
         self.session.cookies = self.parse_cookie_string()
+        mount_session(self.session)
+        # 本次运行中批量获取的章节，key为 (bookId, synckey)
+        self.chapter_cache = {}
+        self.session_lock = threading.Lock()
+        self.warmed_at = None
+        self.warm_up_count = 0
+        self.rate_limiter = RateLimiter(WEREAD_RATE_LIMIT)
+        atexit.register(self.report)
+
+    def warm_up(self, force=False):
+        """访问首页刷新会话，会话在有效期内不重复访问"""
+        with self.session_lock:
+            if (
+                not force
+                and self.warmed_at is not None
+                and time.monotonic() - self.warmed_at < SESSION_TTL
+            ):
+                return
+            print("正在访问微信读书首页...")
+            self.send("GET", WEREAD_URL)
+            self.warmed_at = time.monotonic()
+            self.warm_up_count += 1
+
+    def is_auth_error(self, r):
+        if r.ok:
+            return False
+        return get_json(r).get("errcode") in AUTH_ERRCODES
+
+    def request(self, method, url, **kwargs):
+        """发送请求，会话失效时重新访问首页并重试一次"""
+        self.warm_up()
+        r = self.send(method, url, **kwargs)
+        if self.is_auth_error(r):
+            print("微信读书会话失效，重新访问首页...")
+            metrics.record_retry("weread", get_route(method, url))
+            self.warm_up(force=True)
+            r = self.send(method, url, **kwargs)
+        return r
+
+    def send(self, method, url, **kwargs):
+        """限流后发送请求，记录耗时和返回内容的大小"""
+        self.rate_limiter.acquire()
+        route = get_route(method, url)
+        started_at = time.monotonic()
+        try:
+            r = self.session.request(method, url, **kwargs)
+        except Exception:
+            metrics.record("weread", route, time.monotonic() - started_at, ok=False)
+            raise
+        metrics.record("weread", route, time.monotonic() - started_at, ok=r.ok)
+        metrics.record_bytes("weread", route, len(r.content))
+        if r.status_code == 429:
+            metrics.record_rate_limited("weread", route)
+        return r
+
+    def report(self):
+        print(f"本次运行共访问微信读书首页{self.warm_up_count}次")
 
     def try_get_cloud_cookie(self, url, id, password):
         if url.endswith("/"):
@@ -50,6 +179,9 @@ class WeReadApi:
         return result
 
     def get_cookie(self):
+        if get_mode() == REPLAY:
+            # 回放时不访问网络，cookie不会被使用
+            return os.getenv("WEREAD_COOKIE") or "wr_skey=replay"
         url = os.getenv("CC_URL")
         if not url:
             url = "https://cookiecloud.malinkang.com/"
@@ -78,18 +210,18 @@ class WeReadApi:
         return cookiejar
 
     def get_bookshelf(self):
-        print("正在访问微信读书首页...")
-        self.session.get(WEREAD_URL)
         print("正在获取书架信息...")
-        r = self.session.get(
-            "https://weread.qq.com/web/shelf/sync?synckey=0&teenmode=0&album=1&onlyBookid=0"
+        r = self.request(
+            "GET",
+            "https://weread.qq.com/web/shelf/sync?synckey=0&teenmode=0&album=1&onlyBookid=0",
         )
         if r.ok:
+            data = get_json(r)
             print("成功获取书架信息")
-            print(f"请求 get_bookshelf 内容: {json.dumps(r.json(), indent=4, ensure_ascii=False)}")
-            return r.json()
+            trace_response("get_bookshelf", r, data)
+            return data
         else:
-            errcode = r.json().get("errcode", 0)
+            errcode = get_json(r).get("errcode", 0)
             self.handle_errcode(errcode)
             raise Exception(f"Could not get bookshelf {r.text}")
 
@@ -100,62 +232,59 @@ class WeReadApi:
     @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def get_notebooklist(self):
         """获取笔记本列表"""
-        print("正在访问微信读书首页...")
-        self.session.get(WEREAD_URL)
         print("正在获取笔记本列表...")
-        r = self.session.get(WEREAD_NOTEBOOKS_URL)
+        r = self.request("GET", WEREAD_NOTEBOOKS_URL)
         if r.ok:
-            data = r.json()
+            data = get_json(r)
             books = data.get("books")
             books.sort(key=lambda x: x["sort"])
             print("成功获取笔记本列表")
-            print(f"请求 get_notebooklist 内容: {json.dumps(data, indent=4, ensure_ascii=False)}")
+            trace_response("get_notebooklist", r, data)
             return books
         else:
-            errcode = r.json().get("errcode", 0)
+            errcode = get_json(r).get("errcode", 0)
             self.handle_errcode(errcode)
             raise Exception(f"Could not get notebook list {r.text}")
 
     @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def get_bookinfo(self, bookId):
         """获取书的详情"""
-        print("正在访问微信读书首页...")
-        self.session.get(WEREAD_URL)
         print(f"正在获取书籍 {bookId} 的详情...")
         params = dict(bookId=bookId)
-        r = self.session.get(WEREAD_BOOK_INFO, params=params)
+        r = self.request("GET", WEREAD_BOOK_INFO, params=params)
         if r.ok:
+            data = get_json(r)
             print(f"成功获取书籍 {bookId} 的详情")
-            print(f"请求 get_bookinfo 内容: {json.dumps(r.json(), indent=4, ensure_ascii=False)}")
-            return r.json()
+            trace_response("get_bookinfo", r, data)
+            return data
         else:
-            errcode = r.json().get("errcode", 0)
+            errcode = get_json(r).get("errcode", 0)
             self.handle_errcode(errcode)
             print(f"Could not get book info {r.text}")
 
     @retry(stop_max_attempt_number=3, wait_fixed=5000)
-    def get_bookmark_list(self, bookId):
-        print("正在访问微信读书首页...")
-        self.session.get(WEREAD_URL)
+    def get_bookmark_changes(self, bookId, synckey=0):
+        """增量获取划线，返回 (新增或更新的划线, 删除的划线ID, synckey)，synckey为0时获取全部"""
         print(f"正在获取书籍 {bookId} 的划线列表...")
-        params = dict(bookId=bookId)
-        r = self.session.get(WEREAD_BOOKMARKLIST_URL, params=params)
+        params = dict(bookId=bookId, synckey=synckey)
+        r = self.request("GET", WEREAD_BOOKMARKLIST_URL, params=params)
         if r.ok:
-            with open("bookmark.json", "w") as f:
-                f.write(json.dumps(r.json(), indent=4, ensure_ascii=False))
-            bookmarks = r.json().get("updated")
+            data = get_json(r)
+            bookmarks = parse_bookmarks(data.get("updated", []))
+            removed = get_removed_ids(data.get("removed"), "bookmarkId")
             print(f"成功获取书籍 {bookId} 的划线列表")
-            print(f"请求 get_bookmark_list 内容: {json.dumps(r.json(), indent=4, ensure_ascii=False)}")
-            return bookmarks
+            trace_response("get_bookmark_list", r, data, dump_file="bookmark.json")
+            return bookmarks, removed, data.get("synckey", synckey)
         else:
-            errcode = r.json().get("errcode", 0)
+            errcode = get_json(r).get("errcode", 0)
             self.handle_errcode(errcode)
             raise Exception(f"Could not get {bookId} bookmark list")
 
+    def get_bookmark_list(self, bookId):
+        return self.get_bookmark_changes(bookId)[0]
+
     @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def get_read_info(self, bookId):
-        print("正在访问微信读书首页...")
-        self.session.get(WEREAD_URL)
         print(f"正在获取书籍 {bookId} 的阅读信息...")
         params = dict(
             noteCount=1,
@@ -174,81 +303,116 @@ class WeReadApi:
             "osver": "12",
             "User-Agent": "WeRead/8.2.5 WRBrand/xiaomi Dalvik/2.1.0 (Linux; U; Android 12; Redmi Note 7 Pro Build/SQ3A.220705.004)",
         }
-        r = self.session.get(WEREAD_READ_INFO_URL, headers=headers, params=params)
+        r = self.request("GET", WEREAD_READ_INFO_URL, headers=headers, params=params)
         if r.ok:
+            data = get_json(r)
             print(f"成功获取书籍 {bookId} 的阅读信息")
-            print(f"请求 get_read_info 内容: {json.dumps(r.json(), indent=4, ensure_ascii=False)}")
-            return r.json()
+            trace_response("get_read_info", r, data)
+            return data
         else:
-            errcode = r.json().get("errcode", 0)
+            errcode = get_json(r).get("errcode", 0)
             self.handle_errcode(errcode)
             raise Exception(f"get {bookId} read info failed {r.text}")
 
     @retry(stop_max_attempt_number=3, wait_fixed=5000)
-    def get_review_list(self, bookId):
-        print("正在访问微信读书首页...")
-        self.session.get(WEREAD_URL)
+    def get_review_changes(self, bookId, synckey=0):
+        """增量获取笔记，返回 (新增或更新的笔记, 删除的笔记ID, synckey)，synckey为0时获取全部"""
         print(f"正在获取书籍 {bookId} 的笔记列表...")
-        params = dict(bookId=bookId, listType=11, mine=1, syncKey=0)
-        r = self.session.get(WEREAD_REVIEW_LIST_URL, params=params)
+        params = dict(bookId=bookId, listType=11, mine=1, syncKey=synckey)
+        r = self.request("GET", WEREAD_REVIEW_LIST_URL, params=params)
         if r.ok:
-            reviews = r.json().get("reviews")
-            reviews = list(map(lambda x: x.get("review"), reviews))
-            reviews = [
-                {"chapterUid": 1000000, **x} if x.get("type") == 4 else x
-                for x in reviews
-            ]
+            data = get_json(r)
+            reviews = parse_reviews(data.get("reviews", []))
+            removed = get_removed_ids(data.get("removed"), "reviewId")
             print(f"成功获取书籍 {bookId} 的笔记列表")
-            print(f"请求 get_review_list 内容: {json.dumps(r.json(), indent=4, ensure_ascii=False)}")
-            return reviews
+            trace_response("get_review_list", r, data)
+            return reviews, removed, data.get("synckey", synckey)
         else:
-            errcode = r.json().get("errcode", 0)
+            errcode = get_json(r).get("errcode", 0)
             self.handle_errcode(errcode)
             raise Exception(f"get {bookId} review list failed {r.text}")
 
+    def get_review_list(self, bookId):
+        return self.get_review_changes(bookId)[0]
+
+    def get_book_details(self, bookIds):
+        """并发获取书籍详情和阅读信息，按bookIds的顺序返回 (bookId, (bookInfo, readInfo))"""
+        return ordered_map(
+            lambda bookId: (self.get_bookinfo(bookId), self.get_read_info(bookId)),
+            bookIds,
+            WEREAD_CONCURRENCY,
+        )
+
     def get_api_data(self):
-        print("正在访问微信读书首页...")
-        self.session.get(WEREAD_URL)
         print("正在获取历史数据...")
-        r = self.session.get(WEREAD_HISTORY_URL)
+        r = self.request("GET", WEREAD_HISTORY_URL)
         if r.ok:
+            data = get_json(r)
             print("成功获取历史数据")
-            print(f"请求 get_api_data 内容: {json.dumps(r.json(), indent=4, ensure_ascii=False)}")
-            return r.json()
+            trace_response("get_api_data", r, data)
+            return data
         else:
-            errcode = r.json().get("errcode", 0)
+            errcode = get_json(r).get("errcode", 0)
             self.handle_errcode(errcode)
             raise Exception(f"get history data failed {r.text}")
 
     @retry(stop_max_attempt_number=3, wait_fixed=5000)
-    def get_chapter_info(self, bookId):
-        print("正在访问微信读书首页...")
-        self.session.get(WEREAD_URL)
-        print(f"正在获取书籍 {bookId} 的章节信息...")
-        body = {"bookIds": [bookId], "synckeys": [0], "teenmode": 0}
-        r = self.session.post(WEREAD_CHAPTER_INFO, json=body)
-        if (
-            r.ok
-            and "data" in r.json()
-            and len(r.json()["data"]) == 1
-            and "updated" in r.json()["data"][0]
-        ):
-            update = r.json()["data"][0]["updated"]
-            update.append(
-                {
-                    "chapterUid": 1000000,
-                    "chapterIdx": 1000000,
-                    "updateTime": 1683825006,
-                    "readAhead": 0,
-                    "title": "点评",
-                    "level": 1,
-                }
-            )
-            print(f"成功获取书籍 {bookId} 的章节信息")
-            print(f"请求 get_chapter_info 内容: {json.dumps(r.json(), indent=4, ensure_ascii=False)}")
-            return {item["chapterUid"]: item for item in update}
+    def get_chapter_changes_batch(self, synckeys):
+        """一次请求获取多本书的章节，synckeys为 {bookId: synckey}，返回 {bookId: (新增或更新的章节, 删除的章节Uid, synckey)}"""
+        bookIds = list(synckeys.keys())
+        print(f"正在获取{len(bookIds)}本书的章节信息...")
+        body = {
+            "bookIds": bookIds,
+            "synckeys": [synckeys.get(bookId) for bookId in bookIds],
+            "teenmode": 0,
+        }
+        r = self.request("POST", WEREAD_CHAPTER_INFO, json=body)
+        response = get_json(r)
+        if r.ok and "data" in response and len(response["data"]) == len(bookIds):
+            result = {}
+            for index, data in enumerate(response["data"]):
+                bookId = data.get("bookId", bookIds[index])
+                if "updated" not in data:
+                    continue
+                removed = get_removed_ids(data.get("removed"), "chapterUid")
+                result[bookId] = (
+                    parse_chapters(data["updated"]),
+                    removed,
+                    data.get("synckey", synckeys.get(bookId)),
+                )
+            print(f"成功获取{len(bookIds)}本书的章节信息")
+            trace_response("get_chapter_info", r, response)
+            return result
         else:
-            raise Exception(f"get {bookId} chapter info failed {r.text}")
+            raise Exception(f"get {bookIds} chapter info failed {r.text}")
+
+    def prefetch_chapters(self, synckeys):
+        """按CHAPTER_BATCH_SIZE分批获取章节并缓存，之后的get_chapter_changes直接读取缓存"""
+        bookIds = list(synckeys.keys())
+        for i in range(0, len(bookIds), CHAPTER_BATCH_SIZE):
+            batch = {bookId: synckeys[bookId] for bookId in bookIds[i : i + CHAPTER_BATCH_SIZE]}
+            try:
+                changes = self.get_chapter_changes_batch(batch)
+            except Exception as e:
+                # 批量获取失败不影响同步，之后会单独获取
+                print(f"批量获取章节信息失败: {e}")
+                continue
+            for bookId, value in changes.items():
+                self.chapter_cache[(bookId, batch.get(bookId))] = value
+
+    def get_chapter_changes(self, bookId, synckey=0):
+        """增量获取章节，返回 (新增或更新的章节, 删除的章节Uid, synckey)，synckey为0时获取全部"""
+        if (bookId, synckey) in self.chapter_cache:
+            return self.chapter_cache.pop((bookId, synckey))
+        result = self.get_chapter_changes_batch({bookId: synckey})
+        if bookId not in result:
+            raise Exception(f"get {bookId} chapter info failed")
+        return result.get(bookId)
+
+    def get_chapter_info(self, bookId):
+        update = self.get_chapter_changes(bookId)[0]
+        update.append(replace(REVIEW_CHAPTER))
+        return {item.chapter_uid: item for item in update}
 
     def transform_id(self, book_id):
         id_length = len(book_id)